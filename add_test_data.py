@@ -1,183 +1,195 @@
 #!/usr/bin/env python3
 """
 Script to add test data to the inventory management system
+
+With no arguments it seeds a small demo dataset. Use the options to generate
+large synthetic datasets for benchmarking, e.g.:
+
+    python add_test_data.py --products 5000 --locations 200 --movements 2000000 --skew 1.1
 """
 
+import argparse
+import itertools
 import sqlite3
+import time
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime
 import random
 
-DATABASE = 'inventory.db'
+import app
 
-def init_db():
-    """Initialize the database with required tables"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    # Create Product table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Product (
-            product_id TEXT PRIMARY KEY,
-            product_name TEXT NOT NULL,
-            description TEXT
-        )
-    ''')
-    
-    # Create Location table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Location (
-            location_id TEXT PRIMARY KEY,
-            location_name TEXT NOT NULL,
-            address TEXT
-        )
-    ''')
-    
-    # Create ProductMovement table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ProductMovement (
-            movement_id TEXT PRIMARY KEY,
-            timestamp TEXT NOT NULL,
-            from_location TEXT,
-            to_location TEXT,
-            product_id TEXT NOT NULL,
-            qty INTEGER NOT NULL,
-            FOREIGN KEY (from_location) REFERENCES Location (location_id),
-            FOREIGN KEY (to_location) REFERENCES Location (location_id),
-            FOREIGN KEY (product_id) REFERENCES Product (product_id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+SAMPLE_PRODUCTS = [
+    ('P001', 'Laptop Computer', 'High-performance laptop for business use'),
+    ('P002', 'Office Chair', 'Ergonomic office chair with lumbar support'),
+    ('P003', 'Wireless Mouse', 'Bluetooth wireless mouse with precision tracking'),
+    ('P004', 'Monitor 24"', '24-inch LED monitor with Full HD resolution')
+]
+
+SAMPLE_LOCATIONS = [
+    ('L001', 'Main Warehouse', '123 Industrial Ave, City Center'),
+    ('L002', 'Office Building A', '456 Business St, Downtown'),
+    ('L003', 'Retail Store', '789 Shopping Mall, West Side'),
+    ('L004', 'Distribution Center', '321 Logistics Blvd, East End')
+]
 
-def clear_existing_data():
+# Movements are generated and inserted this many at a time
+BATCH_SIZE = 50000
+
+def clear_existing_data(database):
     """Clear existing data"""
-    conn = sqlite3.connect(DATABASE)
+    conn = sqlite3.connect(database)
     cursor = conn.cursor()
     
+    cursor.execute('DELETE FROM BalanceCheckpointLine')
+    cursor.execute('DELETE FROM BalanceCheckpoint')
+    cursor.execute('DELETE FROM StockBalance')
+    cursor.execute('DELETE FROM DailyMovement')
     cursor.execute('DELETE FROM ProductMovement')
+    for (table,) in cursor.execute('SELECT table_name FROM MovementArchive').fetchall():
+        cursor.execute(f'DROP TABLE {table}')
+    cursor.execute('DELETE FROM MovementArchive')
+    cursor.execute('DELETE FROM TransferDocument')
     cursor.execute('DELETE FROM Product')
     cursor.execute('DELETE FROM Location')
+    # Running app processes must drop their cached lists and pages
+    app.bump_generation(conn, app.REFERENCE_DATA, app.DATA)
     
     conn.commit()
     conn.close()
 
-def add_test_products():
-    """Add test products"""
-    products = [
-        ('P001', 'Laptop Computer', 'High-performance laptop for business use'),
-        ('P002', 'Office Chair', 'Ergonomic office chair with lumbar support'),
-        ('P003', 'Wireless Mouse', 'Bluetooth wireless mouse with precision tracking'),
-        ('P004', 'Monitor 24"', '24-inch LED monitor with Full HD resolution')
+def add_test_products(database, count):
+    """Add test products: the named samples first, then numbered ones"""
+    products = SAMPLE_PRODUCTS[:count] + [
+        (f'P{i:03d}', f'Product {i}', f'Synthetic test product {i}')
+        for i in range(len(SAMPLE_PRODUCTS) + 1, count + 1)
     ]
     
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    for product_id, product_name, description in products:
-        cursor.execute('INSERT INTO Product (product_id, product_name, description) VALUES (?, ?, ?)',
-                      (product_id, product_name, description))
-    
+    conn = sqlite3.connect(database)
+    conn.executemany('INSERT INTO Product (product_id, product_name, description) VALUES (?, ?, ?)', products)
     conn.commit()
     conn.close()
     print(f"Added {len(products)} products")
 
-def add_test_locations():
-    """Add test locations"""
-    locations = [
-        ('L001', 'Main Warehouse', '123 Industrial Ave, City Center'),
-        ('L002', 'Office Building A', '456 Business St, Downtown'),
-        ('L003', 'Retail Store', '789 Shopping Mall, West Side'),
-        ('L004', 'Distribution Center', '321 Logistics Blvd, East End')
+def add_test_locations(database, count):
+    """Add test locations: the named samples first, then numbered ones"""
+    locations = SAMPLE_LOCATIONS[:count] + [
+        (f'L{i:03d}', f'Location {i}', f'{i} Test Street')
+        for i in range(len(SAMPLE_LOCATIONS) + 1, count + 1)
     ]
     
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
-    for location_id, location_name, address in locations:
-        cursor.execute('INSERT INTO Location (location_id, location_name, address) VALUES (?, ?, ?)',
-                      (location_id, location_name, address))
-    
+    conn = sqlite3.connect(database)
+    conn.executemany('INSERT INTO Location (location_id, location_name, address) VALUES (?, ?, ?)', locations)
     conn.commit()
     conn.close()
     print(f"Added {len(locations)} locations")
 
-def add_test_movements():
-    """Add test movements"""
-    conn = sqlite3.connect(DATABASE)
+def zipf_cum_weights(count, skew):
+    """Cumulative weights where item i is picked proportionally to 1 / (i + 1) ** skew"""
+    return list(itertools.accumulate(1 / (i + 1) ** skew for i in range(count)))
+
+def generate_movements(count, product_keys, location_keys, skew, days):
+    """Yield lists of random movement tuples in stored form, BATCH_SIZE at a time"""
+    product_weights = zipf_cum_weights(len(product_keys), skew)
+    location_weights = zipf_cum_weights(len(location_keys), skew)
+    # Timestamps rise through the batches, as they would in real history
+    start = app.to_epoch(datetime.now()) - days * 24 * 60 * 60
+    step = days * 24 * 60 * 60 / max(count, 1)
+    
+    remaining = count
+    while remaining > 0:
+        size = min(BATCH_SIZE, remaining)
+        remaining -= size
+        products = random.choices(product_keys, cum_weights=product_weights, k=size)
+        sources = random.choices(location_keys, cum_weights=location_weights, k=size)
+        targets = random.choices(location_keys, cum_weights=location_weights, k=size)
+        
+        batch = []
+        offset = count - remaining - size
+        for i, (product_key, from_location, to_location) in enumerate(zip(products, sources, targets), offset):
+            # Random movement type; a transfer needs two different locations
+            movement_type = random.choice(['incoming', 'outgoing', 'transfer'])
+            if movement_type == 'transfer' and from_location == to_location:
+                movement_type = 'incoming'
+            if movement_type == 'incoming':
+                from_location = None
+            elif movement_type == 'outgoing':
+                to_location = None
+            
+            moved_at = int(start + (i + random.random()) * step)
+            batch.append((uuid.uuid4().bytes, moved_at, from_location, to_location, product_key,
+                          random.randint(1, 50)))
+        yield batch
+
+def add_test_movements(database, count, skew=0.0, days=30):
+    """Add random test movements in batched executemany inserts"""
+    conn = sqlite3.connect(database)
+    # Bulk-load settings: a crash mid-load only loses test data
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -262144')
     cursor = conn.cursor()
     
     # Get products and locations
-    products = cursor.execute('SELECT product_id FROM Product').fetchall()
-    locations = cursor.execute('SELECT location_id FROM Location').fetchall()
-    
-    product_ids = [p[0] for p in products]
-    location_ids = [l[0] for l in locations]
-    
-    movements = []
-    
-    # Generate 20 random movements
-    for i in range(20):
-        movement_id = str(uuid.uuid4())
-        
-        # Random timestamp within last 30 days
-        days_ago = random.randint(0, 30)
-        hours_ago = random.randint(0, 23)
-        minutes_ago = random.randint(0, 59)
-        
-        timestamp = datetime.now() - timedelta(days=days_ago, hours=hours_ago, minutes=minutes_ago)
-        timestamp_str = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-        
-        product_id = random.choice(product_ids)
-        qty = random.randint(1, 50)
-        
-        # Random movement type
-        movement_type = random.choice(['incoming', 'outgoing', 'transfer'])
-        
-        if movement_type == 'incoming':
-            from_location = None
-            to_location = random.choice(location_ids)
-        elif movement_type == 'outgoing':
-            from_location = random.choice(location_ids)
-            to_location = None
-        else:  # transfer
-            from_location = random.choice(location_ids)
-            to_location = random.choice([loc for loc in location_ids if loc != from_location])
-        
-        movements.append((movement_id, timestamp_str, from_location, to_location, product_id, qty))
-    
-    # Insert movements
-    cursor.executemany('''
-        INSERT INTO ProductMovement (movement_id, timestamp, from_location, to_location, product_id, qty)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', movements)
+    product_keys = [row[0] for row in cursor.execute('SELECT product_key FROM Product ORDER BY product_id')]
+    location_keys = [row[0] for row in cursor.execute('SELECT location_key FROM Location ORDER BY location_id')]
+    
+    inserted = 0
+    for batch in generate_movements(count, product_keys, location_keys, skew, days):
+        cursor.executemany('''
+            INSERT INTO ProductMovement (movement_id, moved_at, from_location_key, to_location_key, product_key, qty)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', batch)
+        inserted += len(batch)
+        if count > BATCH_SIZE:
+            print(f"  {inserted}/{count} movements")
+    app.rebuild_balances(conn)
+    app.rebuild_daily_movements(conn)
     
     conn.commit()
     conn.close()
-    print(f"Added {len(movements)} movements")
+    print(f"Added {inserted} movements")
 
-def main():
-    """Main function to add all test data"""
+def generate_data(database=app.DATABASE, products=4, locations=4, movements=20, skew=0.0, days=30, seed=None):
+    """Replace the contents of `database` with a generated dataset"""
+    if seed is not None:
+        random.seed(seed)
+    
     print("Initializing database...")
-    init_db()
+    app.DATABASE = database
+    app.init_db()
     
     print("Clearing existing data...")
-    clear_existing_data()
+    clear_existing_data(database)
     
     print("Adding test products...")
-    add_test_products()
+    add_test_products(database, products)
     
     print("Adding test locations...")
-    add_test_locations()
+    add_test_locations(database, locations)
     
     print("Adding test movements...")
-    add_test_movements()
-    
-    print("\nTest data added successfully!")
+    add_test_movements(database, movements, skew, days)
+
+def main():
+    """Main function to add all test data"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', default=app.DATABASE, help='SQLite file to fill (default: %(default)s)')
+    parser.add_argument('--products', type=int, default=4, help='number of products (default: %(default)s)')
+    parser.add_argument('--locations', type=int, default=4, help='number of locations (default: %(default)s)')
+    parser.add_argument('--movements', type=int, default=20, help='number of movements (default: %(default)s)')
+    parser.add_argument('--skew', type=float, default=0.0,
+                        help='Zipf exponent for product/location popularity; 0 is uniform (default: %(default)s)')
+    parser.add_argument('--days', type=int, default=30, help='spread movements over this many days (default: %(default)s)')
+    parser.add_argument('--seed', type=int, help='random seed for repeatable datasets')
+    args = parser.parse_args()
+    
+    if args.products < 1 or args.locations < 1:
+        parser.error('at least one product and one location are required')
+    
+    start = time.perf_counter()
+    generate_data(args.database, args.products, args.locations, args.movements, args.skew, args.days, args.seed)
+    
+    print(f"\nTest data added successfully in {time.perf_counter() - start:.1f}s!")
     print("You can now run the Flask application with: python app.py")
 
 if __name__ == '__main__':
     main()
-
-
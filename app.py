@@ -1,22 +1,85 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import (Flask, render_template, request, redirect, url_for, flash, jsonify, g, has_app_context,
+                   send_file, session, stream_with_context)
+import calendar
+import click
+import csv
+import functools
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import queue
+import shutil
 import sqlite3
 import os
+import re
+import tempfile
+import threading
+import time
 import uuid
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from urllib.request import pathname2url
+
+from jinja2 import FileSystemBytecodeCache
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'
+# Compiled templates are kept on disk (in a per-user temp directory), so a new
+# worker process loads them instead of compiling them again
+app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache()}
 
 # Database configuration
 DATABASE = 'inventory.db'
 
-def init_db():
-    """Initialize the database with required tables"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
+# Movement timestamps are stored as text in this layout, so they sort lexically
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+TIMESTAMP_RE = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
+
+# Storage formats
+# Timestamps are stored as integer seconds, reading the wall-clock text as if it
+# were UTC, so every text timestamp round-trips exactly and SQL renders it back
+# with datetime(moved_at, 'unixepoch').
+def to_epoch(timestamp):
+    """Stored seconds for a TIMESTAMP_FORMAT string or a naive datetime"""
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return calendar.timegm(timestamp.timetuple())
+
+def from_epoch(seconds):
+    """TIMESTAMP_FORMAT string for stored seconds"""
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+# Movement IDs in canonical UUID form are stored as their 16 raw bytes; any
+# other ID is kept as text, so the public ID always comes back unchanged.
+def movement_id_key(movement_id):
+    """Stored form of a public movement ID"""
+    try:
+        value = uuid.UUID(movement_id)
+    except (AttributeError, TypeError, ValueError):
+        return movement_id
+    return value.bytes if str(value) == movement_id else movement_id
+
+MOVEMENT_ID_SQL = '''
+    CASE WHEN typeof(pm.movement_id) = 'blob' THEN lower(
+        substr(hex(pm.movement_id), 1, 8) || '-' || substr(hex(pm.movement_id), 9, 4) || '-' ||
+        substr(hex(pm.movement_id), 13, 4) || '-' || substr(hex(pm.movement_id), 17, 4) || '-' ||
+        substr(hex(pm.movement_id), 21)
+    ) ELSE pm.movement_id END
+'''
+
+# Products and locations are exposed without their internal integer keys
+PRODUCT_SELECT_SQL = 'SELECT product_id, product_name, description FROM Product'
+LOCATION_SELECT_SQL = 'SELECT location_id, location_name, address FROM Location'
+
+# Schema migrations
+# Each migration runs once, in order, in its own transaction; PRAGMA user_version
+# records the last one applied so existing inventory.db files upgrade in place.
+def migration_base_tables(conn):
+    """Create the Product, Location and ProductMovement tables"""
     # Create Product table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS Product (
             product_id TEXT PRIMARY KEY,
             product_name TEXT NOT NULL,
@@ -25,7 +88,7 @@ def init_db():
     ''')
     
     # Create Location table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS Location (
             location_id TEXT PRIMARY KEY,
             location_name TEXT NOT NULL,
@@ -34,7 +97,7 @@ def init_db():
     ''')
     
     # Create ProductMovement table
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS ProductMovement (
             movement_id TEXT PRIMARY KEY,
             timestamp TEXT NOT NULL,
@@ -47,16 +110,1211 @@ def init_db():
             FOREIGN KEY (product_id) REFERENCES Product (product_id)
         )
     ''')
+
+def migration_stock_balance(conn):
+    """Create StockBalance (current stock per product/location) and fill it from history"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS StockBalance (
+            product_id TEXT NOT NULL,
+            location_id TEXT NOT NULL,
+            qty INTEGER NOT NULL,
+            PRIMARY KEY (product_id, location_id),
+            FOREIGN KEY (product_id) REFERENCES Product (product_id),
+            FOREIGN KEY (location_id) REFERENCES Location (location_id)
+        ) WITHOUT ROWID
+    ''')
+    # Frozen copy of the balance aggregate for this schema version
+    conn.execute('''
+        INSERT INTO StockBalance (product_id, location_id, qty)
+        SELECT product_id, location_id, SUM(qty)
+        FROM (
+            SELECT product_id, to_location as location_id, qty
+            FROM ProductMovement
+            WHERE to_location IS NOT NULL
+            UNION ALL
+            SELECT product_id, from_location as location_id, -qty
+            FROM ProductMovement
+            WHERE from_location IS NOT NULL
+        )
+        GROUP BY product_id, location_id
+        HAVING SUM(qty) != 0
+    ''')
+
+def migration_movement_indexes(conn):
+    """Index the ProductMovement access paths used by guards, listings and balances"""
+    # Product delete guard and per-product history
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_movement_product ON ProductMovement (product_id, timestamp)')
+    # Location delete guard and both sides of the balance aggregate (covering)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_movement_from ON ProductMovement (from_location, product_id, qty)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_movement_to ON ProductMovement (to_location, product_id, qty)')
+    # Movement listing order
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_movement_timestamp ON ProductMovement (timestamp)')
+
+def migration_keyset_indexes(conn):
+    """Index (timestamp, movement_id) per listing filter for keyset pagination"""
+    conn.execute('DROP INDEX IF EXISTS idx_movement_timestamp')
+    conn.execute('DROP INDEX IF EXISTS idx_movement_product')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_movement_timestamp_id ON ProductMovement (timestamp, movement_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_movement_product_timestamp ON ProductMovement (product_id, timestamp, movement_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_movement_from_timestamp ON ProductMovement (from_location, timestamp, movement_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_movement_to_timestamp ON ProductMovement (to_location, timestamp, movement_id)')
+
+def migration_ingest_batches(conn):
+    """Create IngestBatch, which records idempotency keys of bulk ingests"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS IngestBatch (
+            idempotency_key TEXT PRIMARY KEY,
+            received_at TEXT NOT NULL,
+            rows_inserted INTEGER NOT NULL,
+            rows_rejected INTEGER NOT NULL
+        )
+    ''')
+
+def migration_cache_generations(conn):
+    """Create CacheGeneration, the shared invalidation counters for in-process caches"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS CacheGeneration (
+            name TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+def migration_balance_checkpoints(conn):
+    """Create the balance checkpoint tables used by as-of queries"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS BalanceCheckpoint (
+            as_of TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS BalanceCheckpointLine (
+            as_of TEXT NOT NULL,
+            product_id TEXT NOT NULL,
+            location_id TEXT NOT NULL,
+            qty INTEGER NOT NULL,
+            PRIMARY KEY (as_of, product_id, location_id)
+        ) WITHOUT ROWID
+    ''')
+
+def migration_search_indexes(conn):
+    """Create FTS5 search indexes over products and locations, kept in sync by triggers"""
+    # External-content tables: the text lives in Product/Location only and the
+    # index is keyed by their rowid. prefix='2 3' precomputes short prefixes
+    # so typeahead queries like "lap*" do not walk the whole term list.
+    for table, search_table, columns in SEARCH_TABLES:
+        conn.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {search_table} USING fts5(
+                {', '.join(columns)},
+                content='{table}', content_rowid='rowid',
+                prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    create_search_triggers(conn)
+    rebuild_search_indexes(conn)
+
+def migration_compact_storage(conn):
+    """Rebuild the tables with integer keys, epoch-second timestamps and binary movement IDs"""
+    conn.create_function('movement_id_key', 1, movement_id_key, deterministic=True)
+    # Renaming first frees the table and index names; the old tables are copied and dropped
+    for table in ('Product', 'Location', 'ProductMovement', 'StockBalance',
+                  'BalanceCheckpoint', 'BalanceCheckpointLine'):
+        conn.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
     
-    conn.commit()
-    conn.close()
+    # Movements whose product or location was deleted before foreign keys were
+    # enforced keep their history through a placeholder named after the ID
+    conn.execute('''
+        INSERT INTO Product_old (product_id, product_name)
+        SELECT DISTINCT product_id, product_id FROM ProductMovement_old
+        WHERE product_id NOT IN (SELECT product_id FROM Product_old)
+    ''')
+    conn.execute('''
+        INSERT INTO Location_old (location_id, location_name)
+        SELECT location_id, location_id FROM (
+            SELECT from_location as location_id FROM ProductMovement_old
+            UNION
+            SELECT to_location FROM ProductMovement_old
+        )
+        WHERE location_id IS NOT NULL AND location_id NOT IN (SELECT location_id FROM Location_old)
+    ''')
+    
+    conn.execute('''
+        CREATE TABLE Product (
+            product_key INTEGER PRIMARY KEY,
+            product_id TEXT NOT NULL UNIQUE,
+            product_name TEXT NOT NULL,
+            description TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE Location (
+            location_key INTEGER PRIMARY KEY,
+            location_id TEXT NOT NULL UNIQUE,
+            location_name TEXT NOT NULL,
+            address TEXT
+        )
+    ''')
+    # movement_id holds a 16-byte BLOB for UUIDs and TEXT otherwise (see movement_id_key)
+    conn.execute('''
+        CREATE TABLE ProductMovement (
+            movement_key INTEGER PRIMARY KEY,
+            movement_id BLOB NOT NULL UNIQUE,
+            moved_at INTEGER NOT NULL,
+            product_key INTEGER NOT NULL,
+            from_location_key INTEGER,
+            to_location_key INTEGER,
+            qty INTEGER NOT NULL,
+            FOREIGN KEY (product_key) REFERENCES Product (product_key),
+            FOREIGN KEY (from_location_key) REFERENCES Location (location_key),
+            FOREIGN KEY (to_location_key) REFERENCES Location (location_key)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE StockBalance (
+            product_key INTEGER NOT NULL,
+            location_key INTEGER NOT NULL,
+            qty INTEGER NOT NULL,
+            PRIMARY KEY (product_key, location_key),
+            FOREIGN KEY (product_key) REFERENCES Product (product_key),
+            FOREIGN KEY (location_key) REFERENCES Location (location_key)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE BalanceCheckpoint (
+            as_of INTEGER PRIMARY KEY,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE BalanceCheckpointLine (
+            as_of INTEGER NOT NULL,
+            product_key INTEGER NOT NULL,
+            location_key INTEGER NOT NULL,
+            qty INTEGER NOT NULL,
+            PRIMARY KEY (as_of, product_key, location_key)
+        ) WITHOUT ROWID
+    ''')
+    
+    # Keeping the old rowids as keys keeps the search indexes valid
+    conn.execute('''
+        INSERT INTO Product (product_key, product_id, product_name, description)
+        SELECT rowid, product_id, product_name, description FROM Product_old
+    ''')
+    conn.execute('''
+        INSERT INTO Location (location_key, location_id, location_name, address)
+        SELECT rowid, location_id, location_name, address FROM Location_old
+    ''')
+    # Inserting in history order makes movement_key follow the listing order
+    conn.execute('''
+        INSERT INTO ProductMovement (movement_id, moved_at, product_key, from_location_key, to_location_key, qty)
+        SELECT movement_id_key(m.movement_id), CAST(strftime('%s', m.timestamp) AS INTEGER),
+               p.product_key, fl.location_key, tl.location_key, m.qty
+        FROM ProductMovement_old m
+        JOIN Product p ON p.product_id = m.product_id
+        LEFT JOIN Location fl ON fl.location_id = m.from_location
+        LEFT JOIN Location tl ON tl.location_id = m.to_location
+        ORDER BY m.timestamp, m.movement_id
+    ''')
+    conn.execute('''
+        INSERT INTO BalanceCheckpoint (as_of, created_at)
+        SELECT CAST(strftime('%s', as_of) AS INTEGER), created_at FROM BalanceCheckpoint_old
+    ''')
+    conn.execute('''
+        INSERT INTO BalanceCheckpointLine (as_of, product_key, location_key, qty)
+        SELECT CAST(strftime('%s', c.as_of) AS INTEGER), p.product_key, l.location_key, c.qty
+        FROM BalanceCheckpointLine_old c
+        JOIN Product p ON p.product_id = c.product_id
+        JOIN Location l ON l.location_id = c.location_id
+    ''')
+    for table in ('BalanceCheckpointLine', 'BalanceCheckpoint', 'StockBalance', 'ProductMovement',
+                  'Location', 'Product'):
+        conn.execute(f'DROP TABLE {table}_old')
+    
+    # An index on a rowid table ends with the rowid, so (moved_at) orders by
+    # (moved_at, movement_key) for keyset pagination
+    conn.execute('CREATE INDEX idx_movement_moved_at ON ProductMovement (moved_at)')
+    conn.execute('CREATE INDEX idx_movement_product_moved_at ON ProductMovement (product_key, moved_at)')
+    conn.execute('CREATE INDEX idx_movement_from_moved_at ON ProductMovement (from_location_key, moved_at)')
+    conn.execute('CREATE INDEX idx_movement_to_moved_at ON ProductMovement (to_location_key, moved_at)')
+    # Covering indexes for both sides of the balance aggregate
+    conn.execute('CREATE INDEX idx_movement_from_balance ON ProductMovement (from_location_key, product_key, qty)')
+    conn.execute('CREATE INDEX idx_movement_to_balance ON ProductMovement (to_location_key, product_key, qty)')
+    
+    conn.execute('''
+        INSERT INTO StockBalance (product_key, location_key, qty)
+        SELECT product_key, location_key, SUM(qty)
+        FROM (
+            SELECT product_key, to_location_key as location_key, qty
+            FROM ProductMovement
+            WHERE to_location_key IS NOT NULL
+            UNION ALL
+            SELECT product_key, from_location_key, -qty
+            FROM ProductMovement
+            WHERE from_location_key IS NOT NULL
+        )
+        GROUP BY product_key, location_key
+        HAVING SUM(qty) != 0
+    ''')
+    create_search_triggers(conn)
+    rebuild_search_indexes(conn)
+    bump_generation(conn, REFERENCE_DATA)
+
+def migration_movement_archives(conn):
+    """Create MovementArchive, the registry of per-month movement archive tables"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS MovementArchive (
+            start_at INTEGER PRIMARY KEY,
+            end_at INTEGER NOT NULL UNIQUE,
+            table_name TEXT NOT NULL UNIQUE,
+            movements INTEGER NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+    ''')
+
+def migration_jobs(conn):
+    """Create Job, the queue of background reports and exports"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS Job (
+            job_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            format TEXT NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            result_path TEXT,
+            error TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_job_status_created ON Job (status, created_at)')
+
+def migration_daily_movements(conn):
+    """Create DailyMovement, the per-day inbound/outbound rollup, and fill it from history"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS DailyMovement (
+            product_key INTEGER NOT NULL,
+            location_key INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            inbound INTEGER NOT NULL,
+            outbound INTEGER NOT NULL,
+            PRIMARY KEY (product_key, day, location_key)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_daily_movement_location_day ON DailyMovement (location_key, day)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_daily_movement_day ON DailyMovement (day)')
+    tables = ['ProductMovement'] + [row[0] for row in conn.execute('SELECT table_name FROM MovementArchive')]
+    branches = ' UNION ALL '.join(f'''
+        SELECT product_key, to_location_key as location_key, moved_at, qty as inbound, 0 as outbound
+        FROM {table} WHERE to_location_key IS NOT NULL
+        UNION ALL
+        SELECT product_key, from_location_key, moved_at, 0, qty
+        FROM {table} WHERE from_location_key IS NOT NULL
+    ''' for table in tables)
+    conn.execute(f'''
+        INSERT INTO DailyMovement (product_key, location_key, day, inbound, outbound)
+        SELECT product_key, location_key, (moved_at - (moved_at % 86400 + 86400) % 86400) / 86400,
+               SUM(inbound), SUM(outbound)
+        FROM ({branches})
+        GROUP BY 1, 2, 3
+    ''')
+
+def migration_transfer_documents(conn):
+    """Create TransferDocument and tag movements with the document they belong to"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS TransferDocument (
+            document_key INTEGER PRIMARY KEY,
+            moved_at INTEGER NOT NULL,
+            from_location_key INTEGER,
+            to_location_key INTEGER,
+            reference TEXT,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (from_location_key) REFERENCES Location (location_key),
+            FOREIGN KEY (to_location_key) REFERENCES Location (location_key)
+        )
+    ''')
+    archives = [row[0] for row in conn.execute('SELECT table_name FROM MovementArchive')]
+    for table, index in [('ProductMovement', 'idx_movement_document')] + [(t, f'idx_{t}_document') for t in archives]:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN document_key INTEGER REFERENCES TransferDocument (document_key)')
+        conn.execute(f'CREATE INDEX {index} ON {table} (document_key) WHERE document_key IS NOT NULL')
+
+def migration_reference_indexes(conn):
+    """Index the foreign keys that lacked one, so enforcing them on a location delete never scans"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_balance_location ON StockBalance (location_key)')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transfer_document_from ON TransferDocument (from_location_key)
+        WHERE from_location_key IS NOT NULL
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transfer_document_to ON TransferDocument (to_location_key)
+        WHERE to_location_key IS NOT NULL
+    ''')
+
+def migration_job_heartbeats(conn):
+    """Give each job run an ID and a heartbeat, so only runs whose worker stopped are requeued"""
+    conn.execute('ALTER TABLE Job ADD COLUMN run_id TEXT')
+    conn.execute('ALTER TABLE Job ADD COLUMN heartbeat_at TEXT')
+    # Runs already in progress count from their start, as they did before
+    conn.execute("UPDATE Job SET heartbeat_at = started_at WHERE status = 'running'")
+
+def migration_job_snapshots(conn):
+    """Record which reporting snapshot a job's result was built from"""
+    conn.execute('ALTER TABLE Job ADD COLUMN snapshot_at TEXT')
+
+MIGRATIONS = [
+    migration_base_tables,
+    migration_stock_balance,
+    migration_movement_indexes,
+    migration_keyset_indexes,
+    migration_ingest_batches,
+    migration_cache_generations,
+    migration_balance_checkpoints,
+    migration_search_indexes,
+    migration_compact_storage,
+    migration_movement_archives,
+    migration_jobs,
+    migration_daily_movements,
+    migration_transfer_documents,
+    migration_reference_indexes,
+    migration_job_heartbeats,
+    migration_job_snapshots,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate(conn):
+    """Apply pending migrations; returns the number applied"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f'Database schema version {version} is newer than this app ({SCHEMA_VERSION})')
+    
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute('BEGIN')
+        try:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return SCHEMA_VERSION - version
+
+def init_db():
+    """Initialize the database with required tables"""
+    conn = sqlite3.connect(DATABASE)
+    try:
+        # A current schema needs no DDL, which is the common case for every worker start
+        if conn.execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION:
+            return
+        # WAL is persistent, so setting it once here covers every later connection
+        conn.execute('PRAGMA journal_mode = WAL')
+        migrate(conn)
+    finally:
+        conn.close()
+
+# Connection pool
+# Each worker thread keeps one open connection and reuses it across requests.
+# WAL lets readers run alongside the single writer instead of failing with
+# "database is locked".
+DB_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA foreign_keys = ON',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+]
+
+# Seconds a writer waits for the write lock before raising "database is locked"
+DB_BUSY_TIMEOUT = 10
+
+class PooledConnection(sqlite3.Connection):
+    """Connection whose close() returns it to the pool instead of closing it"""
+
+    def close(self):
+        """Roll back anything uncommitted and keep the connection open for reuse"""
+        if self.in_transaction:
+            self.rollback()
+
+    def dispose(self):
+        """Really close the underlying connection"""
+        super().close()
+
+    def execute(self, sql, parameters=()):
+        profile = getattr(_pool, 'profile', None)
+        if profile is None:
+            return super().execute(sql, parameters)
+        cursor = self.cursor(TimedCursor)
+        cursor.start_timing(profile, sql)
+        return cursor.timed(cursor.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        profile = getattr(_pool, 'profile', None)
+        if profile is None:
+            return super().executemany(sql, seq_of_parameters)
+        cursor = self.cursor(TimedCursor)
+        cursor.start_timing(profile, sql)
+        return cursor.timed(cursor.executemany, sql, seq_of_parameters)
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor used while profiling: the statement's time includes fetching its rows, not just starting it"""
+
+    def start_timing(self, profile, sql):
+        self.profile = profile
+        self.timing = profile.start_statement(sql)
+
+    def timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.profile.record_time(self.timing, time.perf_counter() - start)
+
+    def __next__(self):
+        return self.timed(super().__next__)
+
+    def fetchone(self):
+        return self.timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self.timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self.timed(super().fetchall)
+
+_pool = threading.local()
+# (database, connection) pairs opened by warm_up(); a thread takes one on its
+# first request instead of opening its own
+_warm_connections = queue.SimpleQueue()
+
+def open_db_connection(database=None, check_same_thread=True):
+    """Open a new tuned connection"""
+    conn = sqlite3.connect(database or DATABASE, timeout=DB_BUSY_TIMEOUT, factory=PooledConnection,
+                           check_same_thread=check_same_thread)
+    conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def take_warm_connection():
+    """A connection warm_up() opened for the current database, or None"""
+    while True:
+        try:
+            database, conn = _warm_connections.get_nowait()
+        except queue.Empty:
+            return None
+        if database == DATABASE:
+            return conn
+        conn.dispose()
+
+def get_thread_connection():
+    """Get the current thread's pooled connection, opening it on first use"""
+    conn = getattr(_pool, 'conn', None)
+    if conn is None or _pool.database != DATABASE:
+        if conn is not None:
+            conn.dispose()
+        conn = take_warm_connection() or open_db_connection()
+        _pool.conn = conn
+        _pool.database = DATABASE
+    return conn
+
+def close_thread_connection():
+    """Close the current thread's pooled connection, if any"""
+    conn = getattr(_pool, 'conn', None)
+    if conn is not None:
+        conn.dispose()
+        _pool.conn = None
 
 def get_db_connection():
     """Get database connection"""
-    conn = sqlite3.connect(DATABASE)
+    if not has_app_context():
+        return get_thread_connection()
+    if 'db' not in g:
+        g.db = get_thread_connection()
+        if PROFILE_REQUESTS:
+            g.db.set_trace_callback(trace_statement)
+    return g.db
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    """Hand the request's connection back to the pool"""
+    for name in ('db', 'report_db'):
+        conn = g.pop(name, None)
+        if conn is not None:
+            conn.close()
+
+# Reporting snapshot
+# With INVENTORY_REPORT_SNAPSHOT_SECONDS set, the balance report, exports and
+# analytics read a copy of the database taken with SQLite's online backup API,
+# so their long scans never hold a read transaction open on the file that
+# movement writes go to. A copy is never used once it is older than that many
+# seconds: past half that age the next report takes a new one in the
+# background, and past the full age a report waits for a new one. Each copy is
+# a new file named after the moment it was taken, so reports still reading the
+# previous one are not disturbed. Reports show that moment as `snapshot_at` and
+# send it in an X-Snapshot-At header.
+REPORT_SNAPSHOT_SECONDS = int(os.environ.get('INVENTORY_REPORT_SNAPSHOT_SECONDS') or 0)
+# Older copies are deleted; the previous one is kept for reports still reading it
+REPORT_SNAPSHOTS_KEPT = 2
+REPORT_PRAGMAS = [
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+]
+
+_report_snapshot_lock = threading.Lock()
+
+def report_snapshot_dir():
+    """Directory holding reporting snapshots, next to the database"""
+    return os.path.join(os.path.dirname(os.path.abspath(DATABASE)), 'report_snapshots')
+
+def list_report_snapshots():
+    """(taken_at, path) of every complete snapshot, newest first"""
+    try:
+        entries = list(os.scandir(report_snapshot_dir()))
+    except FileNotFoundError:
+        return []
+    snapshots = []
+    for entry in entries:
+        if match := re.fullmatch(r'(\d+)-\d+\.db', entry.name):
+            snapshots.append((int(match[1]) / 1000, entry.path))
+    return sorted(snapshots, reverse=True)
+
+def take_report_snapshot():
+    """Copy the database into a new snapshot file; returns its (taken_at, path)"""
+    directory = report_snapshot_dir()
+    os.makedirs(directory, exist_ok=True)
+    # The copy reads from a transaction started after this moment, so it is at least this fresh
+    taken_at = time.time()
+    path = os.path.join(directory, f'{int(taken_at * 1000)}-{os.getpid()}.db')
+    source = sqlite3.connect(DATABASE, timeout=DB_BUSY_TIMEOUT)
+    target = sqlite3.connect(path + '.tmp')
+    try:
+        source.backup(target)
+        # Snapshots are opened immutable, which a WAL-mode file cannot be
+        target.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        target.close()
+        source.close()
+    os.replace(path + '.tmp', path)
+    
+    for _, old_path in list_report_snapshots()[REPORT_SNAPSHOTS_KEPT:]:
+        try:
+            os.remove(old_path)
+        except OSError:  # Still open on Windows; a later refresh removes it
+            pass
+    return taken_at, path
+
+def refresh_report_snapshot_in_background():
+    """Take a snapshot, then release the lock current_report_snapshot() acquired"""
+    try:
+        take_report_snapshot()
+    except Exception:
+        app.logger.exception('Reporting snapshot failed')
+    finally:
+        _report_snapshot_lock.release()
+
+def current_report_snapshot():
+    """(taken_at, path) of a snapshot no older than REPORT_SNAPSHOT_SECONDS, taking one if needed"""
+    snapshots = list_report_snapshots()
+    if not snapshots or time.time() - snapshots[0][0] >= REPORT_SNAPSHOT_SECONDS:
+        with _report_snapshot_lock:
+            # Another thread may have taken one while this one waited
+            snapshots = list_report_snapshots()
+            if not snapshots or time.time() - snapshots[0][0] >= REPORT_SNAPSHOT_SECONDS:
+                return take_report_snapshot()
+            return snapshots[0]
+    
+    if (time.time() - snapshots[0][0] >= REPORT_SNAPSHOT_SECONDS / 2
+            and _report_snapshot_lock.acquire(blocking=False)):
+        threading.Thread(target=refresh_report_snapshot_in_background, daemon=True).start()
+    return snapshots[0]
+
+def open_report_snapshot(path):
+    """Open a read-only connection to one snapshot file"""
+    # immutable: the file never changes, so SQLite skips locking it altogether
+    conn = sqlite3.connect(f'file:{pathname2url(path)}?immutable=1', uri=True, factory=PooledConnection)
     conn.row_factory = sqlite3.Row
+    for pragma in REPORT_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+def get_report_connection():
+    """(connection, snapshot_at) for a report: the current snapshot, or the live database and None"""
+    if not REPORT_SNAPSHOT_SECONDS:
+        return get_db_connection(), None
+    if has_app_context() and 'report_db' in g:
+        return g.report_db, g.snapshot_at
+    
+    taken_at, path = current_report_snapshot()
+    conn = getattr(_pool, 'report_conn', None)
+    if conn is None or _pool.report_path != path:
+        if conn is not None:
+            conn.dispose()
+        conn = open_report_snapshot(path)
+        _pool.report_conn = conn
+        _pool.report_path = path
+    snapshot_at = datetime.fromtimestamp(taken_at).strftime(TIMESTAMP_FORMAT)
+    
+    if has_app_context():
+        if PROFILE_REQUESTS:
+            conn.set_trace_callback(trace_statement)
+        g.report_db = conn
+        g.snapshot_at = snapshot_at
+    return conn, snapshot_at
+
+@app.after_request
+def add_snapshot_header(response):
+    """Tell clients which moment a report read from the snapshot shows"""
+    snapshot_at = g.get('snapshot_at')
+    if snapshot_at:
+        response.headers['X-Snapshot-At'] = snapshot_at
+    return response
+
+# Request profiling and metrics
+# With INVENTORY_PROFILE=1 every request records its wall time, how many SQL
+# statements it ran (counted by the sqlite3 trace callback, so executemany rows
+# and trigger statements are included), total SQL time and its slowest
+# statements. N+1 detection counts execute() and executemany() calls instead,
+# so a batched write counts once however many rows it has. Totals per endpoint
+# are served at /metrics in Prometheus text format.
+PROFILE_REQUESTS = os.environ.get('INVENTORY_PROFILE') == '1'
+# A statement shape repeated this often in one request is flagged as N+1
+N_PLUS_ONE_THRESHOLD = 20
+SLOWEST_STATEMENTS_KEPT = 3
+
+class RequestProfile:
+    """SQL activity of one request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        # [seconds, sql] per statement run, timed by TimedCursor
+        self.timings = []
+        self.shapes = {}
+
+    def record_statement(self):
+        self.statements += 1
+
+    def start_statement(self, sql):
+        """Count one execute() or executemany() of a statement; returns its new timing entry"""
+        shape = statement_shape(sql)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+        timing = [0.0, sql]
+        self.timings.append(timing)
+        return timing
+
+    def record_time(self, timing, seconds):
+        """Add time spent running or fetching a statement to its entry"""
+        timing[0] += seconds
+        self.sql_seconds += seconds
+
+    def slowest(self):
+        """(seconds, sql) of the SLOWEST_STATEMENTS_KEPT slowest statement runs"""
+        timings = sorted(self.timings, key=lambda timing: timing[0], reverse=True)[:SLOWEST_STATEMENTS_KEPT]
+        return [(seconds, ' '.join(sql.split())) for seconds, sql in timings]
+
+    def repeated_shapes(self):
+        """Statement shapes run at least N_PLUS_ONE_THRESHOLD times, most frequent first"""
+        return sorted(((count, shape) for shape, count in self.shapes.items()
+                       if count >= N_PLUS_ONE_THRESHOLD), reverse=True)
+
+_metrics_lock = threading.Lock()
+# (endpoint, method, status) -> request count
+_request_counts = {}
+# endpoint -> [requests, wall seconds, statements, SQL seconds, N+1 requests]
+_endpoint_totals = {}
+
+def statement_shape(sql):
+    """SQL with literals replaced by ?, so repeats of one query with different values match"""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(\.\d+)?\b', '?', sql)
+    return ' '.join(sql.split())
+
+def trace_statement(sql):
+    """sqlite3 trace callback: count the statement against the current request"""
+    profile = getattr(_pool, 'profile', None)
+    if profile is not None:
+        profile.record_statement()
+
+@app.before_request
+def start_request_profile():
+    if PROFILE_REQUESTS and request.endpoint != 'metrics':
+        _pool.profile = RequestProfile()
+
+@app.after_request
+def finish_request_profile(response):
+    profile = getattr(_pool, 'profile', None)
+    if profile is None:
+        return response
+    _pool.profile = None
+    
+    wall_seconds = time.perf_counter() - profile.start
+    repeated = profile.repeated_shapes()
+    endpoint = request.endpoint or 'unknown'
+    with _metrics_lock:
+        key = (endpoint, request.method, str(response.status_code))
+        _request_counts[key] = _request_counts.get(key, 0) + 1
+        totals = _endpoint_totals.setdefault(endpoint, [0, 0.0, 0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += wall_seconds
+        totals[2] += profile.statements
+        totals[3] += profile.sql_seconds
+        totals[4] += 1 if repeated else 0
+    
+    response.headers['X-SQL-Statements'] = str(profile.statements)
+    response.headers['Server-Timing'] = (f'app;dur={wall_seconds * 1000:.2f}, '
+                                         f'sql;dur={profile.sql_seconds * 1000:.2f}')
+    app.logger.info('%s %s %d: %.1f ms, %d SQL statements (%.1f ms)', request.method, request.path,
+                    response.status_code, wall_seconds * 1000, profile.statements, profile.sql_seconds * 1000)
+    for seconds, sql in profile.slowest():
+        app.logger.debug('  %.2f ms  %s', seconds * 1000, sql[:200])
+    if repeated:
+        count, shape = repeated[0]
+        response.headers['X-N-Plus-One'] = f'{count}x {shape[:120]}'
+        app.logger.warning('Possible N+1 in %s %s: %d runs of %s', request.method, request.path, count, shape[:200])
+    return response
+
+def prometheus_label(value):
+    """Escape a Prometheus label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metrics_lines():
+    """Prometheus text-format lines for the request metrics"""
+    with _metrics_lock:
+        counts = sorted(_request_counts.items())
+        totals = sorted((endpoint, list(values)) for endpoint, values in _endpoint_totals.items())
+    
+    lines = ['# HELP inventory_requests_total Requests handled, by endpoint, method and status.',
+             '# TYPE inventory_requests_total counter']
+    for (endpoint, method, status), count in counts:
+        lines.append(f'inventory_requests_total{{endpoint="{prometheus_label(endpoint)}",'
+                     f'method="{method}",status="{status}"}} {count}')
+    
+    series = [
+        ('inventory_request_duration_seconds_total', 'Wall time spent in requests.', 1),
+        ('inventory_sql_statements_total', 'SQL statements executed.', 2),
+        ('inventory_sql_duration_seconds_total', 'Time spent executing SQL.', 3),
+        ('inventory_n_plus_one_requests_total', 'Requests that repeated one statement shape N+1 style.', 4),
+    ]
+    for name, help_text, index in series:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for endpoint, values in totals:
+            lines.append(f'{name}{{endpoint="{prometheus_label(endpoint)}"}} {values[index]}')
+    
+    stats = response_cache.stats()
+    for name, metric_type, help_text, key in RESPONSE_CACHE_METRICS:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.append(f'{name} {stats[key]}')
+    return lines
+
+@app.route('/metrics')
+def metrics():
+    """Request and SQL metrics in Prometheus text format"""
+    return app.response_class('\n'.join(metrics_lines()) + '\n',
+                              mimetype='text/plain; version=0.0.4')
+
+# Reference-data cache
+# Products and locations change rarely but feed every movement form, so their
+# sorted lists are cached in-process. Each cached copy is tagged with a generation
+# counter kept in the CacheGeneration table; writes bump the counter in the same
+# transaction, which also keeps separate worker processes coherent.
+REFERENCE_DATA = 'reference'
+# Bumped by every product, location and movement write; keys the response cache
+DATA = 'data'
+
+_reference_cache = {}
+_reference_cache_lock = threading.Lock()
+
+def bump_generation(conn, *names):
+    """Invalidate cached copies of each of `names`; runs in the caller's transaction"""
+    conn.executemany('''
+        INSERT INTO CacheGeneration (name, generation) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET generation = generation + 1
+    ''', [(name,) for name in names])
+
+def read_generation(conn, name):
+    """Current generation of `name`"""
+    row = conn.execute('SELECT generation FROM CacheGeneration WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+def load_reference_data(conn):
+    """Query the sorted product and location lists"""
+    products = conn.execute(f'{PRODUCT_SELECT_SQL} ORDER BY product_name').fetchall()
+    locations = conn.execute(f'{LOCATION_SELECT_SQL} ORDER BY location_name').fetchall()
+    return products, locations
+
+def get_reference_data(conn):
+    """Sorted (products, locations) lists, served from the cache while still current"""
+    if conn.in_transaction:
+        # Mid-write the connection may see uncommitted rows; never cache those
+        return load_reference_data(conn)
+    
+    # Read the generation and the lists in one snapshot so they always match
+    conn.execute('BEGIN')
+    try:
+        generation = read_generation(conn, REFERENCE_DATA)
+        cached = _reference_cache.get(DATABASE)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        data = load_reference_data(conn)
+    finally:
+        conn.commit()
+    
+    with _reference_cache_lock:
+        _reference_cache[DATABASE] = (generation, data)
+    return data
+
+# Response cache
+# The movement listing and balance report are cached as rendered pages, keyed
+# on the full URL and the DATA generation, plus the snapshot time for reports.
+# A write bumps the generation, so pages rendered before it are never served
+# again; they age out of the LRU order. The generation is read before the page is built, so a page can only
+# be newer than its key, never older. Pages are neither served from nor stored
+# in the cache when flash messages are involved, since those differ per user.
+RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+class ResponseCache:
+    """Thread-safe LRU map of rendered page bodies, capped by total body size"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Cached (body, mimetype) for key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, mimetype):
+        """Store a page, evicting least recently used ones beyond max_bytes"""
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = (body, mimetype)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'bytes': self.size}
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES)
+
+RESPONSE_CACHE_METRICS = [
+    ('inventory_response_cache_hits_total', 'counter', 'Pages served from the response cache.', 'hits'),
+    ('inventory_response_cache_misses_total', 'counter', 'Cacheable pages that had to be rendered.', 'misses'),
+    ('inventory_response_cache_entries', 'gauge', 'Pages held in the response cache.', 'entries'),
+    ('inventory_response_cache_bytes', 'gauge', 'Bytes of page bodies held in the response cache.', 'bytes'),
+]
+
+def cached_response(view=None, report=False):
+    """Serve a GET view from response_cache while no write has happened since it was rendered.
+
+    With report=True the view reads get_report_connection(), so pages are
+    keyed on the snapshot they were rendered from.
+    """
+    if view is None:
+        return functools.partial(cached_response, report=report)
+    
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if session.get('_flashes'):
+            return view(*args, **kwargs)
+        
+        conn, snapshot_at = get_report_connection() if report else (get_db_connection(), None)
+        key = (DATABASE, request.full_path, read_generation(conn, DATA), snapshot_at)
+        cached = response_cache.get(key)
+        if cached is not None:
+            return app.response_class(cached[0], mimetype=cached[1])
+        
+        response = app.make_response(view(*args, **kwargs))
+        # A view that flashed (for example about a bad parameter) rendered a one-off page
+        if response.status_code == 200 and not session.modified and not response.is_streamed:
+            response_cache.put(key, response.get_data(), response.mimetype)
+        return response
+    return wrapper
+
+# Search
+# Products and locations are searched through FTS5 indexes (see
+# migration_search_indexes). User input is reduced to words and every word is
+# matched as a prefix, so "lap mou" finds "Laptop Mouse" and FTS5 syntax in the
+# input can never cause a query error.
+SEARCH_TABLES = [
+    ('Product', 'ProductSearch', ('product_name', 'description')),
+    ('Location', 'LocationSearch', ('location_name', 'address')),
+]
+
+# Rows shown on /products?q= and /locations?q=
+SEARCH_PAGE_LIMIT = 200
+TYPEAHEAD_DEFAULT_LIMIT = 10
+TYPEAHEAD_MAX_LIMIT = 50
+
+# bm25 weights: a hit in the name counts ten times a hit in the description/address
+PRODUCT_SEARCH_SQL = '''
+    SELECT p.product_id, p.product_name, p.description FROM ProductSearch
+    JOIN Product p ON p.rowid = ProductSearch.rowid
+    WHERE ProductSearch MATCH ?
+    ORDER BY bm25(ProductSearch, 10.0, 1.0), p.product_name
+    LIMIT ?
+'''
+
+LOCATION_SEARCH_SQL = '''
+    SELECT l.location_id, l.location_name, l.address FROM LocationSearch
+    JOIN Location l ON l.rowid = LocationSearch.rowid
+    WHERE LocationSearch MATCH ?
+    ORDER BY bm25(LocationSearch, 10.0, 1.0), l.location_name
+    LIMIT ?
+'''
+
+def search_match_expression(text):
+    """Turn free text into an FTS5 expression matching every word as a prefix, or None"""
+    words = re.findall(r'\w+', text or '')
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+def search_products(conn, text, limit=SEARCH_PAGE_LIMIT):
+    """Products matching `text`, best match first"""
+    expression = search_match_expression(text)
+    if expression is None:
+        return []
+    return conn.execute(PRODUCT_SEARCH_SQL, (expression, limit)).fetchall()
+
+def search_locations(conn, text, limit=SEARCH_PAGE_LIMIT):
+    """Locations matching `text`, best match first"""
+    expression = search_match_expression(text)
+    if expression is None:
+        return []
+    return conn.execute(LOCATION_SEARCH_SQL, (expression, limit)).fetchall()
+
+def create_search_triggers(conn):
+    """Create the triggers that keep the search indexes in sync with their tables"""
+    for table, search_table, columns in SEARCH_TABLES:
+        new_values = ', '.join(f'new.{column}' for column in columns)
+        old_values = ', '.join(f'old.{column}' for column in columns)
+        insert = f'INSERT INTO {search_table} (rowid, {", ".join(columns)}) VALUES (new.rowid, {new_values});'
+        delete = (f'INSERT INTO {search_table} ({search_table}, rowid, {", ".join(columns)}) '
+                  f"VALUES ('delete', old.rowid, {old_values});")
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {search_table}_insert AFTER INSERT ON {table} BEGIN {insert} END')
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {search_table}_delete AFTER DELETE ON {table} BEGIN {delete} END')
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {search_table}_update AFTER UPDATE ON {table} '
+                     f'BEGIN {delete} {insert} END')
+
+def rebuild_search_indexes(conn):
+    """Rebuild the FTS5 indexes from Product and Location; runs in the caller's transaction"""
+    for _, search_table, _ in SEARCH_TABLES:
+        conn.execute(f"INSERT INTO {search_table} ({search_table}) VALUES ('rebuild')")
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Rebuild the product and location search indexes"""
+    init_db()
+    conn = sqlite3.connect(DATABASE)
+    rebuild_search_indexes(conn)
+    conn.commit()
+    conn.close()
+    click.echo('Search indexes rebuilt')
+
+# Hot queries
+# Shared by the routes and check-query-plans so the checked SQL is the SQL that runs
+# Queries that read movements take the table as {table}: ProductMovement or an archive
+# Delete guards probe one index per side and stop at the first referencing row
+PRODUCT_REFERENCED_SQL = '''
+    SELECT EXISTS (
+        SELECT 1 FROM {table} WHERE product_key = (SELECT product_key FROM Product WHERE product_id = ?)
+    )
+'''
+
+LOCATION_REFERENCED_SQL = '''
+    SELECT EXISTS (
+        SELECT 1 FROM {table} WHERE from_location_key = (SELECT location_key FROM Location WHERE location_id = ?)
+    ) OR EXISTS (
+        SELECT 1 FROM {table} WHERE to_location_key = (SELECT location_key FROM Location WHERE location_id = ?)
+    )
+'''
+
+# Movements in their public shape: text IDs and TIMESTAMP_FORMAT timestamps, plus
+# the internal movement_key that listing cursors carry (movement_payload() drops it)
+MOVEMENT_SELECT_SQL = f'''
+    SELECT {MOVEMENT_ID_SQL} as movement_id,
+           datetime(pm.moved_at, 'unixepoch') as timestamp,
+           fl.location_id as from_location,
+           tl.location_id as to_location,
+           p.product_id, pm.qty, p.product_name,
+           fl.location_name as from_location_name,
+           tl.location_name as to_location_name,
+           pm.document_key as document,
+           pm.movement_key
+    FROM {{table}} pm
+    JOIN Product p ON pm.product_key = p.product_key
+    LEFT JOIN Location fl ON pm.from_location_key = fl.location_key
+    LEFT JOIN Location tl ON pm.to_location_key = tl.location_key
+'''
+
+MOVEMENT_ORDER_SQL = 'ORDER BY pm.moved_at DESC, pm.movement_key DESC'
+
+MOVEMENT_DIRECTIONS = {
+    'incoming': 'pm.from_location_key IS NULL AND pm.to_location_key IS NOT NULL',
+    'outgoing': 'pm.from_location_key IS NOT NULL AND pm.to_location_key IS NULL',
+    'transfer': 'pm.from_location_key IS NOT NULL AND pm.to_location_key IS NOT NULL',
+}
+
+def parse_date(value):
+    """Datetime for a YYYY-MM-DD string, or None if it is not a valid date"""
+    try:
+        return datetime.strptime(value or '', '%Y-%m-%d')
+    except ValueError:
+        return None
+
+def build_movement_query(filters, cursor=None, limit=None, table='ProductMovement'):
+    """Build the movement listing query for one movement table as (sql, params).
+
+    filters may hold product_id, location_id, direction, date_from and
+    date_to (YYYY-MM-DD, inclusive) and document (a transfer document number). cursor is the (moved_at, movement_key)
+    of the last row already shown; rows strictly after it in listing order
+    are returned, so every page is an index range read of `limit` rows. The
+    cursor carries the values themselves, so it stays exact even if that row
+    has since been deleted.
+    list_movements() runs it over the live table and the archives.
+    """
+    where = []
+    params = []
+    if filters.get('product_id'):
+        where.append('pm.product_key = (SELECT product_key FROM Product WHERE product_id = ?)')
+        params.append(filters['product_id'])
+    if filters.get('direction') in MOVEMENT_DIRECTIONS:
+        where.append(MOVEMENT_DIRECTIONS[filters['direction']])
+    document = str(filters.get('document') or '')
+    if document.isdigit():
+        where.append('pm.document_key = ?')
+        params.append(int(document))
+    date_from = parse_date(filters.get('date_from'))
+    if date_from:
+        where.append('pm.moved_at >= ?')
+        params.append(to_epoch(date_from))
+    date_to = parse_date(filters.get('date_to'))
+    if date_to:
+        where.append('pm.moved_at < ?')
+        params.append(to_epoch(date_to + timedelta(days=1)))
+    if cursor:
+        where.append('(pm.moved_at, pm.movement_key) < (?, ?)')
+        params.extend(cursor)
+    limit_sql = 'LIMIT ?' if limit else ''
+    limit_params = [limit] if limit else []
+
+    select_sql = MOVEMENT_SELECT_SQL.format(table=table)
+    if not filters.get('location_id'):
+        where_sql = f'WHERE {" AND ".join(where)}' if where else ''
+        return f'{select_sql} {where_sql} {MOVEMENT_ORDER_SQL} {limit_sql}', params + limit_params
+
+    # A location matches on either side. Each side is read in listing order from
+    # its own (location, moved_at) index and the two are merged, which avoids
+    # sorting the location's whole history for every page.
+    branches = []
+    branch_params = []
+    for column in ('from_location_key', 'to_location_key'):
+        branch_where = ' AND '.join(where + [f'pm.{column} = (SELECT location_key FROM Location WHERE location_id = ?)'])
+        branches.append(f'''
+            SELECT * FROM (
+                SELECT pm.movement_key FROM {table} pm
+                WHERE {branch_where} {MOVEMENT_ORDER_SQL} {limit_sql}
+            )
+        ''')
+        branch_params += params + [filters['location_id']] + limit_params
+    sql = f'''
+        {select_sql}
+        WHERE pm.movement_key IN ({' UNION '.join(branches)})
+        {MOVEMENT_ORDER_SQL} {limit_sql}
+    '''
+    return sql, branch_params + limit_params
+
+def movement_cursor(row):
+    """The "timestamp|movement_key" cursor for the page after this listing row"""
+    return f"{row['timestamp']}|{row['movement_key']}"
+
+def parse_movement_cursor(value):
+    """Turn a "timestamp|movement_key" cursor string into stored (moved_at, movement_key), or None"""
+    if not value or '|' not in value:
+        return None
+    timestamp, movement_key = value.split('|', 1)
+    if not TIMESTAMP_RE.fullmatch(timestamp) or not movement_key.isdigit():
+        return None
+    try:
+        return to_epoch(timestamp), int(movement_key)
+    except ValueError:
+        return None
+
+def movement_payload(row):
+    """A movement row as API JSON, without its internal movement_key"""
+    payload = dict(row)
+    del payload['movement_key']
+    return payload
+
+def hot_queries():
+    """Queries that must be served from an index, as name -> SQL"""
+    return {
+        'product delete guard': PRODUCT_REFERENCED_SQL.format(table='ProductMovement'),
+        'location delete guard': LOCATION_REFERENCED_SQL.format(table='ProductMovement'),
+        'movement listing': build_movement_query({}, (0, 0), 50)[0],
+        'movement listing by product': build_movement_query({'product_id': 'P', 'date_from': '2000-01-01'},
+                                                            (0, 0), 50)[0],
+        'movement listing by location': build_movement_query({'location_id': 'L'}, (0, 0), 50)[0],
+        'balance aggregate': BALANCE_AGGREGATE_SQL,
+        'analytics by product': analytics_query(ANALYTICS_DEFAULT_DAYS, product_id='P')[0],
+        'movement series': movement_series_query(ANALYTICS_DEFAULT_DAYS, ANALYTICS_DEFAULT_BUCKET)[0],
+        'product search': PRODUCT_SEARCH_SQL,
+        'location search': LOCATION_SEARCH_SQL,
+    }
+
+def find_table_scans(conn, sql):
+    """Return the EXPLAIN QUERY PLAN lines where a table is scanned without an index"""
+    params = (None,) * sql.count('?')
+    plan = conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+    # "SCAN pm USING INDEX ..." and scans of subquery results are fine; a bare "SCAN pm" is not
+    subqueries = {match[1] for row in plan if (match := re.fullmatch(r'(?:MATERIALIZE|CO-ROUTINE) (\w+)', row[3]))}
+    return [row[3] for row in plan
+            if (match := re.fullmatch(r'SCAN (\w+)', row[3])) and match[1] not in subqueries]
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if a hot query falls back to a full table scan"""
+    init_db()
+    conn = sqlite3.connect(DATABASE)
+    failed = False
+    for name, sql in hot_queries().items():
+        scans = find_table_scans(conn, sql)
+        if scans:
+            failed = True
+            click.echo(f'{name}: {", ".join(scans)}')
+        else:
+            click.echo(f'{name}: ok')
+    conn.close()
+    if failed:
+        raise SystemExit(1)
+
 # Home page
 @app.route('/')
 def index():
@@ -66,11 +1324,12 @@ def index():
 # Product routes
 @app.route('/products')
 def view_products():
-    """View all products"""
+    """View all products, or those matching ?q="""
+    q = request.args.get('q', '').strip()
     conn = get_db_connection()
-    products = conn.execute('SELECT * FROM Product ORDER BY product_name').fetchall()
+    products = search_products(conn, q) if q else get_reference_data(conn)[0]
     conn.close()
-    return render_template('products.html', products=products)
+    return render_template('products.html', products=products, q=q)
 
 @app.route('/products/add', methods=['GET', 'POST'])
 def add_product():
@@ -88,6 +1347,7 @@ def add_product():
             conn = get_db_connection()
             conn.execute('INSERT INTO Product (product_id, product_name, description) VALUES (?, ?, ?)',
                         (product_id, product_name, description))
+            bump_generation(conn, REFERENCE_DATA, DATA)
             conn.commit()
             conn.close()
             flash('Product added successfully!', 'success')
@@ -109,18 +1369,19 @@ def edit_product(product_id):
         
         if not product_name:
             flash('Product Name is required!', 'error')
-            product = conn.execute('SELECT * FROM Product WHERE product_id = ?', (product_id,)).fetchone()
+            product = conn.execute(f'{PRODUCT_SELECT_SQL} WHERE product_id = ?', (product_id,)).fetchone()
             conn.close()
             return render_template('edit_product.html', product=product)
         
-        conn.execute('UPDATE Product SET product_name = ?, description = ? WHERE product_id = ?',
-                    (product_name, description, product_id))
+        if conn.execute('UPDATE Product SET product_name = ?, description = ? WHERE product_id = ?',
+                        (product_name, description, product_id)).rowcount:
+            bump_generation(conn, REFERENCE_DATA, DATA)
         conn.commit()
         conn.close()
         flash('Product updated successfully!', 'success')
         return redirect(url_for('view_products'))
     
-    product = conn.execute('SELECT * FROM Product WHERE product_id = ?', (product_id,)).fetchone()
+    product = conn.execute(f'{PRODUCT_SELECT_SQL} WHERE product_id = ?', (product_id,)).fetchone()
     conn.close()
     
     if product is None:
@@ -129,20 +1390,34 @@ def edit_product(product_id):
     
     return render_template('edit_product.html', product=product)
 
+def remove_product(conn, product_id):
+    """Delete a product; returns False if it does not exist.
+
+    Raises IntegrityError if it is still referenced. The movement probe and
+    the delete run in one write transaction, and the enforced foreign keys
+    refuse the delete if any other row still points at the product. The
+    caller commits.
+    """
+    begin_write(conn)
+    if movements_exist(conn, PRODUCT_REFERENCED_SQL, (product_id,)):
+        raise sqlite3.IntegrityError(f'Product {product_id!r} has movements')
+    deleted = conn.execute('DELETE FROM Product WHERE product_id = ?', (product_id,)).rowcount
+    if deleted:
+        bump_generation(conn, REFERENCE_DATA, DATA)
+    return deleted > 0
+
 @app.route('/products/delete/<product_id>')
 def delete_product(product_id):
     """Delete product"""
     conn = get_db_connection()
     
-    # Check if product has movements
-    movements = conn.execute('SELECT COUNT(*) as count FROM ProductMovement WHERE product_id = ?', (product_id,)).fetchone()
-    
-    if movements['count'] > 0:
+    try:
+        remove_product(conn, product_id)
+    except sqlite3.IntegrityError:
         flash('Cannot delete product with existing movements!', 'error')
         conn.close()
         return redirect(url_for('view_products'))
     
-    conn.execute('DELETE FROM Product WHERE product_id = ?', (product_id,))
     conn.commit()
     conn.close()
     flash('Product deleted successfully!', 'success')
@@ -151,11 +1426,12 @@ def delete_product(product_id):
 # Location routes
 @app.route('/locations')
 def view_locations():
-    """View all locations"""
+    """View all locations, or those matching ?q="""
+    q = request.args.get('q', '').strip()
     conn = get_db_connection()
-    locations = conn.execute('SELECT * FROM Location ORDER BY location_name').fetchall()
+    locations = search_locations(conn, q) if q else get_reference_data(conn)[1]
     conn.close()
-    return render_template('locations.html', locations=locations)
+    return render_template('locations.html', locations=locations, q=q)
 
 @app.route('/locations/add', methods=['GET', 'POST'])
 def add_location():
@@ -173,6 +1449,7 @@ def add_location():
             conn = get_db_connection()
             conn.execute('INSERT INTO Location (location_id, location_name, address) VALUES (?, ?, ?)',
                         (location_id, location_name, address))
+            bump_generation(conn, REFERENCE_DATA, DATA)
             conn.commit()
             conn.close()
             flash('Location added successfully!', 'success')
@@ -194,18 +1471,19 @@ def edit_location(location_id):
         
         if not location_name:
             flash('Location Name is required!', 'error')
-            location = conn.execute('SELECT * FROM Location WHERE location_id = ?', (location_id,)).fetchone()
+            location = conn.execute(f'{LOCATION_SELECT_SQL} WHERE location_id = ?', (location_id,)).fetchone()
             conn.close()
             return render_template('edit_location.html', location=location)
         
-        conn.execute('UPDATE Location SET location_name = ?, address = ? WHERE location_id = ?',
-                    (location_name, address, location_id))
+        if conn.execute('UPDATE Location SET location_name = ?, address = ? WHERE location_id = ?',
+                        (location_name, address, location_id)).rowcount:
+            bump_generation(conn, REFERENCE_DATA, DATA)
         conn.commit()
         conn.close()
         flash('Location updated successfully!', 'success')
         return redirect(url_for('view_locations'))
     
-    location = conn.execute('SELECT * FROM Location WHERE location_id = ?', (location_id,)).fetchone()
+    location = conn.execute(f'{LOCATION_SELECT_SQL} WHERE location_id = ?', (location_id,)).fetchone()
     conn.close()
     
     if location is None:
@@ -214,43 +1492,171 @@ def edit_location(location_id):
     
     return render_template('edit_location.html', location=location)
 
+def remove_location(conn, location_id):
+    """Delete a location; returns False if it does not exist.
+
+    Raises IntegrityError if it is still referenced, like remove_product().
+    """
+    begin_write(conn)
+    if movements_exist(conn, LOCATION_REFERENCED_SQL, (location_id, location_id)):
+        raise sqlite3.IntegrityError(f'Location {location_id!r} has movements')
+    deleted = conn.execute('DELETE FROM Location WHERE location_id = ?', (location_id,)).rowcount
+    if deleted:
+        bump_generation(conn, REFERENCE_DATA, DATA)
+    return deleted > 0
+
 @app.route('/locations/delete/<location_id>')
 def delete_location(location_id):
     """Delete location"""
     conn = get_db_connection()
     
-    # Check if location has movements
-    movements = conn.execute('SELECT COUNT(*) as count FROM ProductMovement WHERE from_location = ? OR to_location = ?', 
-                           (location_id, location_id)).fetchone()
-    
-    if movements['count'] > 0:
+    try:
+        remove_location(conn, location_id)
+    except sqlite3.IntegrityError:
         flash('Cannot delete location with existing movements!', 'error')
         conn.close()
         return redirect(url_for('view_locations'))
     
-    conn.execute('DELETE FROM Location WHERE location_id = ?', (location_id,))
     conn.commit()
     conn.close()
     flash('Location deleted successfully!', 'success')
     return redirect(url_for('view_locations'))
 
 # Movement routes
+MOVEMENTS_PER_PAGE = 50
+MOVEMENT_FILTERS = ('product_id', 'location_id', 'direction', 'date_from', 'date_to', 'document')
+
+def begin_write(conn):
+    """Start a write transaction now, so reads made inside it cannot go stale"""
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+
+def movement_keys(conn, product_id, from_location, to_location):
+    """Resolve public IDs to (product_key, from_location_key, to_location_key).
+
+    Raises IntegrityError naming the first ID that does not exist.
+    """
+    product_key, from_location_key, to_location_key = conn.execute('''
+        SELECT (SELECT product_key FROM Product WHERE product_id = ?),
+               (SELECT location_key FROM Location WHERE location_id = ?),
+               (SELECT location_key FROM Location WHERE location_id = ?)
+    ''', (product_id, from_location, to_location)).fetchone()
+    if product_key is None:
+        raise sqlite3.IntegrityError(f'Unknown product: {product_id!r}')
+    for location_id, location_key in ((from_location, from_location_key), (to_location, to_location_key)):
+        if location_id and location_key is None:
+            raise sqlite3.IntegrityError(f'Unknown location: {location_id!r}')
+    return product_key, from_location_key, to_location_key
+
+def find_movement(conn, movement_id):
+    """Stored row of a live movement (keys and moved_at), or None.
+
+    Raises ClosedPeriodError if the movement has been archived.
+    """
+    movement = conn.execute('''
+        SELECT movement_key, moved_at, product_key, from_location_key, to_location_key, qty, document_key
+        FROM ProductMovement WHERE movement_id = ?
+    ''', (movement_id_key(movement_id),)).fetchone()
+    if movement is None and get_movement(conn, movement_id) is not None:
+        raise ClosedPeriodError(archive_horizon(conn))
+    return movement
+
+def get_movement(conn, movement_id):
+    """One movement with product and location names, live or archived, or None"""
+    for table in movement_tables(conn):
+        movement = conn.execute(f'{MOVEMENT_SELECT_SQL.format(table=table)} WHERE pm.movement_id = ?',
+                                (movement_id_key(movement_id),)).fetchone()
+        if movement is not None:
+            return movement
+    return None
+
+def create_movement(conn, product_id, from_location, to_location, qty, timestamp=None):
+    """Insert a movement and update StockBalance; returns the new movement_id.
+
+    Like the other movement write helpers, this leaves the commit to the
+    caller so the movement and its balance change land together.
+    """
+    movement_id = uuid.uuid4()
+    moved_at = to_epoch(timestamp or datetime.now())
+    begin_write(conn)
+    check_open_period(conn, moved_at)
+    product_key, from_location_key, to_location_key = movement_keys(conn, product_id, from_location, to_location)
+    conn.execute('''
+        INSERT INTO ProductMovement (movement_id, moved_at, product_key, from_location_key, to_location_key, qty)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (movement_id.bytes, moved_at, product_key, from_location_key, to_location_key, qty))
+    apply_movement(conn, product_key, from_location_key, to_location_key, qty)
+    apply_daily_deltas(conn, daily_deltas(product_key, from_location_key, to_location_key, moved_at, qty))
+    invalidate_checkpoints(conn, moved_at)
+    bump_generation(conn, DATA)
+    return str(movement_id)
+
+def update_movement(conn, movement_id, product_id, from_location, to_location, qty):
+    """Update a movement and StockBalance; returns False if it does not exist"""
+    begin_write(conn)
+    old = find_movement(conn, movement_id)
+    if old is None:
+        return False
+    product_key, from_location_key, to_location_key = movement_keys(conn, product_id, from_location, to_location)
+    conn.execute('''
+        UPDATE ProductMovement 
+        SET product_key = ?, from_location_key = ?, to_location_key = ?, qty = ?
+        WHERE movement_key = ?
+    ''', (product_key, from_location_key, to_location_key, qty, old['movement_key']))
+    # Reverse the old movement and apply the new values as one net change, so
+    # strict mode only checks what actually leaves each location
+    deltas = movement_deltas(old['product_key'], old['from_location_key'], old['to_location_key'], -old['qty'])
+    movement_deltas(product_key, from_location_key, to_location_key, qty, deltas)
+    apply_balance_deltas(conn, deltas)
+    daily = daily_deltas(old['product_key'], old['from_location_key'], old['to_location_key'],
+                         old['moved_at'], -old['qty'])
+    daily_deltas(product_key, from_location_key, to_location_key, old['moved_at'], qty, daily)
+    apply_daily_deltas(conn, daily)
+    invalidate_checkpoints(conn, old['moved_at'])
+    bump_generation(conn, DATA)
+    return True
+
+def remove_movement(conn, movement_id):
+    """Delete a movement and reverse it in StockBalance; returns False if it does not exist"""
+    begin_write(conn)
+    old = find_movement(conn, movement_id)
+    if old is None:
+        return False
+    conn.execute('DELETE FROM ProductMovement WHERE movement_key = ?', (old['movement_key'],))
+    if old['document_key'] is not None:
+        conn.execute('''
+            DELETE FROM TransferDocument WHERE document_key = ?
+            AND NOT EXISTS (SELECT 1 FROM ProductMovement WHERE document_key = ?)
+        ''', (old['document_key'], old['document_key']))
+    apply_movement(conn, old['product_key'], old['from_location_key'], old['to_location_key'], -old['qty'])
+    apply_daily_deltas(conn, daily_deltas(old['product_key'], old['from_location_key'], old['to_location_key'],
+                                          old['moved_at'], -old['qty']))
+    invalidate_checkpoints(conn, old['moved_at'])
+    bump_generation(conn, DATA)
+    return True
+
 @app.route('/movements')
+@cached_response
 def view_movements():
-    """View all movements"""
-    conn = get_db_connection()
-    movements = conn.execute('''
-        SELECT pm.*, p.product_name, 
-               fl.location_name as from_location_name,
-               tl.location_name as to_location_name
-        FROM ProductMovement pm
-        JOIN Product p ON pm.product_id = p.product_id
-        LEFT JOIN Location fl ON pm.from_location = fl.location_id
-        LEFT JOIN Location tl ON pm.to_location = tl.location_id
-        ORDER BY pm.timestamp DESC
-    ''').fetchall()
+    """View movements, one page at a time"""
+    filters = {key: request.args.get(key, '') for key in MOVEMENT_FILTERS}
+    cursor = parse_movement_cursor(request.args.get('cursor'))
+    
+    conn = get_db_connection()
+    movements = list_movements(conn, filters, cursor, MOVEMENTS_PER_PAGE + 1)
+    # One extra row tells us whether there is a next page
+    next_cursor = None
+    if len(movements) > MOVEMENTS_PER_PAGE:
+        movements = movements[:MOVEMENTS_PER_PAGE]
+        next_cursor = movement_cursor(movements[-1])
+    # A document's lines share a timestamp and were inserted together, so they
+    # are adjacent in listing order and the template can group them under it
+    documents = get_transfer_headers(conn, {row['document'] for row in movements if row['document']})
+    products, locations = get_reference_data(conn)
     conn.close()
-    return render_template('movements.html', movements=movements)
+    
+    return render_template('movements.html', movements=movements, filters=filters, documents=documents,
+                           next_cursor=next_cursor, products=products, locations=locations)
 
 @app.route('/movements/add', methods=['GET', 'POST'])
 def add_movement():
@@ -265,39 +1671,29 @@ def add_movement():
         
         if not product_id or not qty:
             flash('Product and Quantity are required!', 'error')
-            products = conn.execute('SELECT * FROM Product ORDER BY product_name').fetchall()
-            locations = conn.execute('SELECT * FROM Location ORDER BY location_name').fetchall()
+            products, locations = get_reference_data(conn)
             conn.close()
             return render_template('add_movement.html', products=products, locations=locations)
         
         if not from_location and not to_location:
             flash('Either From Location or To Location must be specified!', 'error')
-            products = conn.execute('SELECT * FROM Product ORDER BY product_name').fetchall()
-            locations = conn.execute('SELECT * FROM Location ORDER BY location_name').fetchall()
+            products, locations = get_reference_data(conn)
             conn.close()
             return render_template('add_movement.html', products=products, locations=locations)
         
-        movement_id = str(uuid.uuid4())
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
         try:
-            conn.execute('''
-                INSERT INTO ProductMovement (movement_id, timestamp, from_location, to_location, product_id, qty)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (movement_id, timestamp, from_location, to_location, product_id, qty))
+            create_movement(conn, product_id, from_location, to_location, qty)
             conn.commit()
             conn.close()
             flash('Movement added successfully!', 'success')
             return redirect(url_for('view_movements'))
         except sqlite3.IntegrityError as e:
             flash(f'Error adding movement: {str(e)}', 'error')
-            products = conn.execute('SELECT * FROM Product ORDER BY product_name').fetchall()
-            locations = conn.execute('SELECT * FROM Location ORDER BY location_name').fetchall()
+            products, locations = get_reference_data(conn)
             conn.close()
             return render_template('add_movement.html', products=products, locations=locations)
     
-    products = conn.execute('SELECT * FROM Product ORDER BY product_name').fetchall()
-    locations = conn.execute('SELECT * FROM Location ORDER BY location_name').fetchall()
+    products, locations = get_reference_data(conn)
     conn.close()
     return render_template('add_movement.html', products=products, locations=locations)
 
@@ -314,41 +1710,36 @@ def edit_movement(movement_id):
         
         if not product_id or not qty:
             flash('Product and Quantity are required!', 'error')
-            movement = conn.execute('SELECT * FROM ProductMovement WHERE movement_id = ?', (movement_id,)).fetchone()
-            products = conn.execute('SELECT * FROM Product ORDER BY product_name').fetchall()
-            locations = conn.execute('SELECT * FROM Location ORDER BY location_name').fetchall()
+            movement = get_movement(conn, movement_id)
+            products, locations = get_reference_data(conn)
             conn.close()
             return render_template('edit_movement.html', movement=movement, products=products, locations=locations)
         
         if not from_location and not to_location:
             flash('Either From Location or To Location must be specified!', 'error')
-            movement = conn.execute('SELECT * FROM ProductMovement WHERE movement_id = ?', (movement_id,)).fetchone()
-            products = conn.execute('SELECT * FROM Product ORDER BY product_name').fetchall()
-            locations = conn.execute('SELECT * FROM Location ORDER BY location_name').fetchall()
+            movement = get_movement(conn, movement_id)
+            products, locations = get_reference_data(conn)
             conn.close()
             return render_template('edit_movement.html', movement=movement, products=products, locations=locations)
         
         try:
-            conn.execute('''
-                UPDATE ProductMovement 
-                SET product_id = ?, from_location = ?, to_location = ?, qty = ?
-                WHERE movement_id = ?
-            ''', (product_id, from_location, to_location, qty, movement_id))
+            found = update_movement(conn, movement_id, product_id, from_location, to_location, qty)
             conn.commit()
             conn.close()
+            if not found:
+                flash('Movement not found!', 'error')
+                return redirect(url_for('view_movements'))
             flash('Movement updated successfully!', 'success')
             return redirect(url_for('view_movements'))
         except sqlite3.IntegrityError as e:
             flash(f'Error updating movement: {str(e)}', 'error')
-            movement = conn.execute('SELECT * FROM ProductMovement WHERE movement_id = ?', (movement_id,)).fetchone()
-            products = conn.execute('SELECT * FROM Product ORDER BY product_name').fetchall()
-            locations = conn.execute('SELECT * FROM Location ORDER BY location_name').fetchall()
+            movement = get_movement(conn, movement_id)
+            products, locations = get_reference_data(conn)
             conn.close()
             return render_template('edit_movement.html', movement=movement, products=products, locations=locations)
     
-    movement = conn.execute('SELECT * FROM ProductMovement WHERE movement_id = ?', (movement_id,)).fetchone()
-    products = conn.execute('SELECT * FROM Product ORDER BY product_name').fetchall()
-    locations = conn.execute('SELECT * FROM Location ORDER BY location_name').fetchall()
+    movement = get_movement(conn, movement_id)
+    products, locations = get_reference_data(conn)
     conn.close()
     
     if movement is None:
@@ -361,54 +1752,2006 @@ def edit_movement(movement_id):
 def delete_movement(movement_id):
     """Delete movement"""
     conn = get_db_connection()
-    conn.execute('DELETE FROM ProductMovement WHERE movement_id = ?', (movement_id,))
-    conn.commit()
+    try:
+        remove_movement(conn, movement_id)
+        conn.commit()
+    except sqlite3.IntegrityError as e:
+        conn.close()
+        flash(f'Error deleting movement: {str(e)}', 'error')
+        return redirect(url_for('view_movements'))
     conn.close()
     flash('Movement deleted successfully!', 'success')
     return redirect(url_for('view_movements'))
 
-# Balance report
-@app.route('/balance-report')
-def balance_report():
-    """Generate balance report"""
-    conn = get_db_connection()
-    
-    # Get all products and locations
-    products = conn.execute('SELECT * FROM Product ORDER BY product_name').fetchall()
-    locations = conn.execute('SELECT * FROM Location ORDER BY location_name').fetchall()
-    
-    # Calculate balances
-    balances = []
-    for product in products:
-        for location in locations:
-            # Calculate incoming quantity (to_location)
-            incoming = conn.execute('''
-                SELECT COALESCE(SUM(qty), 0) as total
-                FROM ProductMovement 
-                WHERE product_id = ? AND to_location = ?
-            ''', (product['product_id'], location['location_id'])).fetchone()
-            
-            # Calculate outgoing quantity (from_location)
-            outgoing = conn.execute('''
-                SELECT COALESCE(SUM(qty), 0) as total
-                FROM ProductMovement 
-                WHERE product_id = ? AND from_location = ?
-            ''', (product['product_id'], location['location_id'])).fetchone()
-            
-            balance = incoming['total'] - outgoing['total']
-            
-            if balance != 0:  # Only show non-zero balances
-                balances.append({
-                    'product_id': product['product_id'],
-                    'product_name': product['product_name'],
-                    'location_id': location['location_id'],
-                    'location_name': location['location_name'],
-                    'balance': balance
-                })
+# Bulk movement ingestion
+INGEST_CHUNK_SIZE = 5000
+# Per-row errors kept in the response; the rejected count is always exact
+INGEST_MAX_ERRORS = 1000
+# Uploads larger than this are spooled to a temporary file instead of memory
+INGEST_SPOOL_SIZE = 8 * 1024 * 1024
+
+class IngestFormatError(ValueError):
+    """The input stopped being readable as UTF-8 CSV or NDJSON; nothing was ingested"""
+
+def iter_csv_rows(stream):
+    """Yield (row, parse_error) from a CSV text stream with a header line"""
+    for row in csv.DictReader(stream):
+        yield row, None
+
+def iter_ndjson_rows(stream):
+    """Yield (row, parse_error) from a newline-delimited JSON text stream"""
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield None, f'Invalid JSON: {e}'
+            continue
+        if not isinstance(row, dict):
+            yield None, 'Each line must be a JSON object'
+            continue
+        yield row, None
+
+def parse_ingest_row(row, product_keys, location_keys, default_moved_at, horizon=None):
+    """Validate one incoming row; returns (stored movement tuple, None) or (None, error).
+
+    product_keys and location_keys map public IDs to their integer keys;
+    timestamps before `horizon` fall in an archived period and are refused.
+    """
+    product_id = str(row.get('product_id') or '').strip()
+    from_location = str(row.get('from_location') or '').strip() or None
+    to_location = str(row.get('to_location') or '').strip() or None
+    timestamp = str(row.get('timestamp') or '').strip()
     
-    conn.close()
-    return render_template('balance_report.html', balances=balances)
+    if product_id not in product_keys:
+        return None, f'Unknown product: {product_id!r}'
+    if not from_location and not to_location:
+        return None, 'Either from_location or to_location must be specified'
+    for location_id in (from_location, to_location):
+        if location_id and location_id not in location_keys:
+            return None, f'Unknown location: {location_id!r}'
+    if from_location == to_location:
+        return None, 'from_location and to_location must differ'
+    try:
+        qty = int(str(row.get('qty')).strip())
+    except (TypeError, ValueError):
+        return None, f'Invalid qty: {row.get("qty")!r}'
+    if qty <= 0:
+        return None, 'qty must be positive'
+    moved_at = default_moved_at
+    if timestamp:
+        # fromisoformat is much faster than strptime; the regex pins the exact layout
+        try:
+            if not TIMESTAMP_RE.fullmatch(timestamp):
+                raise ValueError
+            moved_at = to_epoch(timestamp)
+        except ValueError:
+            return None, f'Invalid timestamp: {timestamp!r}'
+        if horizon is not None and moved_at < horizon:
+            return None, f'Timestamp {timestamp!r} falls in an archived period'
+    
+    return (uuid.uuid4().bytes, moved_at, location_keys.get(from_location), location_keys.get(to_location),
+            product_keys[product_id], qty, None), None
+
+def insert_movement_chunk(conn, movements):
+    """Insert a chunk of movement tuples and fold them into StockBalance and DailyMovement"""
+    conn.executemany('''
+        INSERT INTO ProductMovement (movement_id, moved_at, from_location_key, to_location_key, product_key, qty,
+                                     document_key)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', movements)
+    
+    deltas = {}
+    daily = {}
+    for _, moved_at, from_location_key, to_location_key, product_key, qty, _ in movements:
+        movement_deltas(product_key, from_location_key, to_location_key, qty, deltas)
+        daily_deltas(product_key, from_location_key, to_location_key, moved_at, qty, daily)
+    apply_balance_deltas(conn, deltas)
+    apply_daily_deltas(conn, daily)
+    invalidate_checkpoints(conn, min(movement[1] for movement in movements))
+
+def get_ingest_batch(conn, idempotency_key):
+    """Result of an already ingested batch with this key, or None"""
+    if not idempotency_key:
+        return None
+    batch = conn.execute('SELECT * FROM IngestBatch WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+    if batch is None:
+        return None
+    return {'inserted': batch['rows_inserted'], 'rejected': batch['rows_rejected'],
+            'errors': [], 'duplicate': True}
+
+def ingest_movements(conn, rows, idempotency_key=None, chunk_size=INGEST_CHUNK_SIZE):
+    """Validate and insert movements from an iterable of (row, parse_error).
+
+    Rows are validated against in-memory product and location ID maps and
+    written with executemany in chunks, so memory stays bounded by
+    chunk_size. The whole batch commits as one transaction together with its
+    idempotency key: a retried batch with the same key is not applied again,
+    and the stored result of the first attempt is returned instead.
+    """
+    previous = get_ingest_batch(conn, idempotency_key)
+    if previous is not None:
+        return previous
+    
+    inserted = 0
+    rejected = 0
+    errors = []
+    chunk = []
+    row_number = 0
+    try:
+        # The ID maps and the horizon are read inside the write transaction, so
+        # no concurrent product, location or archive change can make them stale
+        begin_write(conn)
+        product_keys = dict(conn.execute('SELECT product_id, product_key FROM Product').fetchall())
+        location_keys = dict(conn.execute('SELECT location_id, location_key FROM Location').fetchall())
+        received_at = datetime.now()
+        default_moved_at = to_epoch(received_at)
+        horizon = archive_horizon(conn)
+        
+        # Rows are numbered from 1 in data order (the CSV header is not counted)
+        for row_number, (row, error) in enumerate(rows, start=1):
+            movement = None
+            if error is None:
+                movement, error = parse_ingest_row(row, product_keys, location_keys, default_moved_at, horizon)
+            if error is not None:
+                rejected += 1
+                if len(errors) < INGEST_MAX_ERRORS:
+                    errors.append({'row': row_number, 'error': error})
+                continue
+            
+            chunk.append(movement)
+            if len(chunk) >= chunk_size:
+                insert_movement_chunk(conn, chunk)
+                inserted += len(chunk)
+                chunk = []
+        if chunk:
+            insert_movement_chunk(conn, chunk)
+            inserted += len(chunk)
+        if inserted:
+            bump_generation(conn, DATA)
+        
+        if idempotency_key:
+            conn.execute('''
+                INSERT INTO IngestBatch (idempotency_key, received_at, rows_inserted, rows_rejected)
+                VALUES (?, ?, ?, ?)
+            ''', (idempotency_key, received_at.strftime(TIMESTAMP_FORMAT), inserted, rejected))
+        conn.commit()
+    except (UnicodeDecodeError, csv.Error) as e:
+        conn.rollback()
+        # Text is decoded ahead of the parser, so the bad bytes may sit a few rows further on
+        raise IngestFormatError(f'Unreadable input at or after row {row_number + 1}: {e}') from e
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        # Another request with the same key committed first
+        previous = get_ingest_batch(conn, idempotency_key)
+        if previous is not None:
+            return previous
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    
+    return {'inserted': inserted, 'rejected': rejected, 'errors': errors, 'duplicate': False}
+
+def ingest_row_reader(stream, data_format):
+    """Pick the row reader for a format name ('csv' or 'ndjson')"""
+    if data_format == 'csv':
+        return iter_csv_rows(stream)
+    if data_format == 'ndjson':
+        return iter_ndjson_rows(stream)
+    raise ValueError(f'Unsupported format: {data_format}')
+
+@app.route('/movements/bulk', methods=['POST'])
+@app.route('/api/v1/movements/bulk', methods=['POST'])
+def bulk_add_movements():
+    """Bulk-ingest movements from a CSV or NDJSON request body"""
+    content_type = request.mimetype
+    if content_type in ('text/csv', 'application/csv'):
+        data_format = 'csv'
+    elif content_type in ('application/x-ndjson', 'application/ndjson', 'application/jsonl'):
+        data_format = 'ndjson'
+    else:
+        return jsonify({'error': 'Content-Type must be text/csv or application/x-ndjson'}), 415
+    
+    # Spool the upload first so a slow client does not hold the write lock
+    with tempfile.SpooledTemporaryFile(max_size=INGEST_SPOOL_SIZE) as upload:
+        shutil.copyfileobj(request.stream, upload)
+        upload.seek(0)
+        stream = io.TextIOWrapper(upload, encoding='utf-8-sig', newline='')
+        conn = get_db_connection()
+        try:
+            result = ingest_movements(conn, ingest_row_reader(stream, data_format),
+                                      request.headers.get('Idempotency-Key'))
+        except InsufficientStockError as e:
+            # Strict mode: the batch would oversell, so none of it was applied
+            return jsonify({'error': str(e)}), 409
+        except IngestFormatError as e:
+            return jsonify({'error': str(e)}), 400
+        finally:
+            conn.close()
+    
+    return jsonify(result), 200 if result['duplicate'] else 201
+
+@app.cli.command('ingest-movements')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'data_format', type=click.Choice(['csv', 'ndjson']),
+              help='Input format; guessed from the file extension when omitted.')
+@click.option('--idempotency-key', help='Skip the file if a batch with this key was already ingested.')
+def ingest_movements_command(path, data_format, idempotency_key):
+    """Bulk-ingest movements from a CSV or NDJSON file"""
+    if data_format is None:
+        data_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    init_db()
+    conn = open_db_connection()
+    try:
+        with open(path, encoding='utf-8-sig', newline='') as stream:
+            result = ingest_movements(conn, ingest_row_reader(stream, data_format), idempotency_key)
+    except (InsufficientStockError, IngestFormatError) as e:
+        raise click.ClickException(f'{e}; nothing was ingested')
+    finally:
+        conn.dispose()
+    
+    for error in result['errors']:
+        click.echo(f"Row {error['row']}: {error['error']}")
+    if result['duplicate']:
+        click.echo(f'Batch {idempotency_key!r} was already ingested')
+    click.echo(f"{result['inserted']} inserted, {result['rejected']} rejected")
+
+# Transfer documents
+# A transfer document moves many products between the same locations at one
+# moment: a header in TransferDocument plus one ProductMovement line per
+# product, tagged with the header's document_key. The whole document is
+# written in one transaction with a single executemany. Its lines stay ordinary
+# movements that can be listed, edited and deleted one by one; the header goes
+# when its last line does.
+TRANSFER_MAX_LINES = 1000
+
+TRANSFER_SELECT_SQL = '''
+    SELECT td.document_key as document,
+           datetime(td.moved_at, 'unixepoch') as timestamp,
+           fl.location_id as from_location,
+           tl.location_id as to_location,
+           td.reference, td.created_at
+    FROM TransferDocument td
+    LEFT JOIN Location fl ON td.from_location_key = fl.location_key
+    LEFT JOIN Location tl ON td.to_location_key = tl.location_key
+'''
+
+def parse_transfer_header(data):
+    """Validate from_location, to_location, timestamp and reference; returns (values, error)"""
+    from_location = str(data.get('from_location') or '').strip() or None
+    to_location = str(data.get('to_location') or '').strip() or None
+    timestamp = str(data.get('timestamp') or '').strip() or None
+    reference = str(data.get('reference') or '').strip() or None
+    
+    if not from_location and not to_location:
+        return None, 'Either from_location or to_location must be specified'
+    if from_location == to_location:
+        return None, 'from_location and to_location must differ'
+    if timestamp:
+        try:
+            if not TIMESTAMP_RE.fullmatch(timestamp):
+                raise ValueError
+            datetime.fromisoformat(timestamp)
+        except ValueError:
+            return None, f'Invalid timestamp: {timestamp!r}'
+    return (from_location, to_location, timestamp, reference), None
+
+def parse_transfer_lines(lines):
+    """Validate [{product_id, qty}, ...]; returns ([(product_id, qty), ...], error)"""
+    if not isinstance(lines, list) or not lines:
+        return None, 'At least one line is required'
+    if len(lines) > TRANSFER_MAX_LINES:
+        return None, f'A document can have at most {TRANSFER_MAX_LINES} lines'
+    parsed = []
+    for number, line in enumerate(lines, start=1):
+        if not isinstance(line, dict):
+            return None, f'Line {number}: must be an object with product_id and qty'
+        product_id = str(line.get('product_id') or '').strip()
+        qty = line.get('qty')
+        if isinstance(qty, str) and qty.strip().isdigit():
+            qty = int(qty)
+        if not product_id or not isinstance(qty, int) or isinstance(qty, bool) or qty <= 0:
+            return None, f'Line {number}: product_id and a positive integer qty are required'
+        parsed.append((product_id, qty))
+    return parsed, None
+
+def create_transfer_document(conn, from_location, to_location, lines, timestamp=None, reference=None):
+    """Write a transfer header and its (product_id, qty) lines; returns the document number.
+
+    Balances, the daily rollup and checkpoints are updated once for the whole
+    document. Leaves the commit to the caller, like the movement helpers.
+    """
+    moved_at = to_epoch(timestamp or datetime.now())
+    begin_write(conn)
+    check_open_period(conn, moved_at)
+    product_ids = sorted({product_id for product_id, _ in lines})
+    product_keys = dict(conn.execute(f'''
+        SELECT product_id, product_key FROM Product WHERE product_id IN ({', '.join('?' * len(product_ids))})
+    ''', product_ids).fetchall())
+    for product_id in product_ids:
+        if product_id not in product_keys:
+            raise sqlite3.IntegrityError(f'Unknown product: {product_id!r}')
+    _, from_location_key, to_location_key = movement_keys(conn, product_ids[0], from_location, to_location)
+    
+    document_key = conn.execute('''
+        INSERT INTO TransferDocument (moved_at, from_location_key, to_location_key, reference, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (moved_at, from_location_key, to_location_key, reference,
+          datetime.now().strftime(TIMESTAMP_FORMAT))).lastrowid
+    insert_movement_chunk(conn, [(uuid.uuid4().bytes, moved_at, from_location_key, to_location_key,
+                                  product_keys[product_id], qty, document_key) for product_id, qty in lines])
+    bump_generation(conn, DATA)
+    return document_key
+
+def get_transfer_headers(conn, documents):
+    """Headers of the given document numbers, as {document: header}"""
+    documents = sorted(documents)
+    rows = conn.execute(f'{TRANSFER_SELECT_SQL} WHERE td.document_key IN ({", ".join("?" * len(documents))})',
+                        documents).fetchall()
+    return {row['document']: dict(row) for row in rows}
+
+def get_transfer_document(conn, document):
+    """A document header with its lines in the order they were entered, or None"""
+    header = conn.execute(f'{TRANSFER_SELECT_SQL} WHERE td.document_key = ?', (document,)).fetchone()
+    if header is None:
+        return None
+    lines = [movement_payload(row) for row in iter_movements(conn, {'document': str(document)})]
+    lines.reverse()
+    return {**dict(header), 'lines': lines}
+
+@app.route('/transfers/add', methods=['GET', 'POST'])
+def add_transfer():
+    """Add a transfer document with many product lines in one submission"""
+    conn = get_db_connection()
+    
+    if request.method == 'POST':
+        # Blank rows of the form's line table are skipped
+        lines = [{'product_id': product_id, 'qty': qty}
+                 for product_id, qty in zip(request.form.getlist('product_id'), request.form.getlist('qty'))
+                 if product_id.strip() or qty.strip()]
+        header, error = parse_transfer_header(request.form)
+        if not error:
+            lines, error = parse_transfer_lines(lines)
+        if not error:
+            from_location, to_location, timestamp, reference = header
+            try:
+                document = create_transfer_document(conn, from_location, to_location, lines, timestamp, reference)
+                conn.commit()
+                conn.close()
+                flash(f'Transfer document {document} added with {len(lines)} lines!', 'success')
+                return redirect(url_for('view_movements', document=document))
+            except sqlite3.IntegrityError as e:
+                error = str(e)
+        flash(f'Error adding transfer: {error}', 'error')
+    
+    products, locations = get_reference_data(conn)
+    conn.close()
+    return render_template('add_transfer.html', products=products, locations=locations)
+
+# Balance engine
+# Strict mode refuses any write that would take a location below zero stock
+STRICT_STOCK = os.environ.get('INVENTORY_STRICT_STOCK') == '1'
+
+class InsufficientStockError(sqlite3.IntegrityError):
+    """A strict-mode write would take a location below zero.
+
+    Subclasses IntegrityError so the routes' existing error handling reports it.
+    """
+
+    def __init__(self, product_id, location_id, available, requested):
+        super().__init__(f'Insufficient stock of {product_id} at {location_id}: '
+                         f'{available} available, {requested} requested')
+        self.product_id = product_id
+        self.location_id = location_id
+        self.available = available
+        self.requested = requested
+
+# Net quantity per product/location key: credits from to_location, debits from
+# from_location, on top of the checkpoint that archival leaves at its horizon
+BALANCE_AGGREGATE_SQL = '''
+    SELECT product_key, location_key, SUM(qty) as balance
+    FROM (
+        SELECT product_key, location_key, qty
+        FROM BalanceCheckpointLine
+        WHERE as_of = (SELECT MAX(end_at) FROM MovementArchive)
+        UNION ALL
+        SELECT product_key, to_location_key as location_key, qty
+        FROM ProductMovement
+        WHERE to_location_key IS NOT NULL
+        UNION ALL
+        SELECT product_key, from_location_key as location_key, -qty
+        FROM ProductMovement
+        WHERE from_location_key IS NOT NULL
+    )
+    GROUP BY product_key, location_key
+    HAVING SUM(qty) != 0
+'''
+
+def compute_balances(conn):
+    """Compute every non-zero product/location balance in one grouped pass.
+
+    Credits come from to_location and debits from from_location; both sides are
+    folded together with a UNION ALL so ProductMovement is read once instead of
+    twice per product/location pair, on top of the archive horizon checkpoint. Rows are ordered the same way the report
+    has always listed them: by product name, then location name.
+    """
+    return conn.execute(f'''
+        SELECT p.product_id, p.product_name,
+               l.location_id, l.location_name,
+               b.balance
+        FROM ({BALANCE_AGGREGATE_SQL}) b
+        JOIN Product p ON b.product_key = p.product_key
+        JOIN Location l ON b.location_key = l.location_key
+        ORDER BY p.product_name, p.product_id, l.location_name, l.location_id
+    ''').fetchall()
+
+def stock_balance_query(product_id=None, location_id=None):
+    """SQL and params reading StockBalance in the same shape and order as compute_balances"""
+    where = []
+    params = []
+    if product_id:
+        where.append('p.product_id = ?')
+        params.append(product_id)
+    if location_id:
+        where.append('l.location_id = ?')
+        params.append(location_id)
+    where_sql = f'WHERE {" AND ".join(where)}' if where else ''
+    return f'''
+        SELECT p.product_id, p.product_name,
+               l.location_id, l.location_name,
+               sb.qty as balance
+        FROM StockBalance sb
+        JOIN Product p ON sb.product_key = p.product_key
+        JOIN Location l ON sb.location_key = l.location_key
+        {where_sql}
+        ORDER BY p.product_name, p.product_id, l.location_name, l.location_id
+    ''', params
+
+def get_stock_balances(conn, product_id=None, location_id=None):
+    """Read current balances from StockBalance, in the same shape and order as compute_balances"""
+    return conn.execute(*stock_balance_query(product_id, location_id)).fetchall()
+
+def movement_deltas(product_key, from_location_key, to_location_key, qty, deltas=None):
+    """Add one movement's balance changes to a {(product_key, location_key): delta} mapping"""
+    if deltas is None:
+        deltas = {}
+    if to_location_key:
+        deltas[(product_key, to_location_key)] = deltas.get((product_key, to_location_key), 0) + qty
+    if from_location_key:
+        deltas[(product_key, from_location_key)] = deltas.get((product_key, from_location_key), 0) - qty
+    return deltas
+
+def apply_balance_deltas(conn, deltas):
+    """Apply a {(product_key, location_key): delta} mapping to StockBalance.
+
+    In strict mode every decrease is a conditional update that only succeeds
+    while enough stock is on hand; otherwise InsufficientStockError is raised
+    and the caller's transaction must be rolled back.
+    """
+    rows = [(product_key, location_key, delta) for (product_key, location_key), delta in deltas.items() if delta]
+    if STRICT_STOCK:
+        for product_key, location_key, delta in rows:
+            if delta > 0:
+                continue
+            updated = conn.execute('''
+                UPDATE StockBalance SET qty = qty + ?
+                WHERE product_key = ? AND location_key = ? AND qty + ? >= 0
+            ''', (delta, product_key, location_key, delta)).rowcount
+            if not updated:
+                row = conn.execute('''
+                    SELECT p.product_id, l.location_id, sb.qty
+                    FROM Product p
+                    JOIN Location l ON l.location_key = ?
+                    LEFT JOIN StockBalance sb ON sb.product_key = p.product_key AND sb.location_key = l.location_key
+                    WHERE p.product_key = ?
+                ''', (location_key, product_key)).fetchone()
+                raise InsufficientStockError(row[0], row[1], row[2] or 0, -delta)
+        rows = [row for row in rows if row[2] > 0]
+    
+    conn.executemany('''
+        INSERT INTO StockBalance (product_key, location_key, qty) VALUES (?, ?, ?)
+        ON CONFLICT (product_key, location_key) DO UPDATE SET qty = qty + excluded.qty
+    ''', rows)
+    # Only pairs with stock are kept, so the report reads O(rows with stock)
+    conn.executemany('DELETE FROM StockBalance WHERE product_key = ? AND location_key = ? AND qty = 0',
+                     list(deltas))
+
+def apply_movement(conn, product_key, from_location_key, to_location_key, qty):
+    """Update StockBalance for one movement; pass a negative qty to reverse it.
+
+    Runs on the caller's connection so the balance change commits or rolls
+    back together with the movement write.
+    """
+    apply_balance_deltas(conn, movement_deltas(product_key, from_location_key, to_location_key, qty))
+
+def balance_drift(conn):
+    """StockBalance rows that differ from movement history, as sorted
+    (product_id, location_id, stored_qty, expected_qty) tuples. Only reads.
+    """
+    rows = conn.execute(f'''
+        SELECT product_key, location_key, SUM(stored), SUM(expected)
+        FROM (
+            SELECT product_key, location_key, qty as stored, 0 as expected FROM StockBalance
+            UNION ALL
+            SELECT product_key, location_key, 0, balance FROM ({BALANCE_AGGREGATE_SQL})
+        )
+        GROUP BY product_key, location_key
+        HAVING SUM(stored) != SUM(expected)
+    ''').fetchall()
+    product_ids = dict(conn.execute('SELECT product_key, product_id FROM Product').fetchall())
+    location_ids = dict(conn.execute('SELECT location_key, location_id FROM Location').fetchall())
+    # A key without its product or location row is reported by its number
+    return sorted((product_ids.get(product_key, f'#{product_key}'), location_ids.get(location_key, f'#{location_key}'),
+                   stored_qty, expected_qty)
+                  for product_key, location_key, stored_qty, expected_qty in rows)
+
+def rebuild_balances(conn):
+    """Recompute StockBalance from the archive horizon checkpoint and live movements.
+
+    Returns the drift found before the rebuild as a list of
+    (product_id, location_id, stored_qty, expected_qty) tuples. The caller
+    commits.
+    """
+    drift = balance_drift(conn)
+    conn.execute('DELETE FROM StockBalance')
+    conn.execute(f'INSERT INTO StockBalance (product_key, location_key, qty) SELECT * FROM ({BALANCE_AGGREGATE_SQL})')
+    if drift:
+        bump_generation(conn, DATA)
+    return drift
+
+@app.cli.command('rebuild-balances')
+@click.option('--check', is_flag=True, help='Only report drift, do not rewrite StockBalance.')
+def rebuild_balances_command(check):
+    """Recompute StockBalance from movement history and report drift"""
+    init_db()
+    conn = sqlite3.connect(DATABASE)
+    if check:
+        drift = balance_drift(conn)
+    else:
+        drift = rebuild_balances(conn)
+        conn.commit()
+    conn.close()
+
+    for product_id, location_id, stored_qty, expected_qty in drift:
+        click.echo(f'Drift {product_id} @ {location_id}: stored {stored_qty}, expected {expected_qty}')
+    click.echo(f'{len(drift)} drifted balance(s) found')
+    if check and drift:
+        raise SystemExit(1)
+
+# Point-in-time balances
+# Balances as of a past moment are served from the nearest earlier checkpoint
+# plus the movements made after it, so the cost depends on recent activity
+# rather than on total history. A checkpoint at `as_of` holds the balances of
+# all movements with timestamp < as_of.
+CHECKPOINT_INTERVAL_DAYS = 1
+
+def parse_as_of(value):
+    """Normalize an as-of value ('YYYY-MM-DD' means end of day); None if invalid"""
+    value = (value or '').strip()
+    if re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+        value = f'{value} 23:59:59'
+    if not TIMESTAMP_RE.fullmatch(value):
+        return None
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return value
+
+def balances_as_of_query(conn, as_of):
+    """SQL and params for non-zero balances including every movement with timestamp <= as_of"""
+    as_of = to_epoch(as_of)
+    checkpoint = conn.execute('SELECT MAX(as_of) FROM BalanceCheckpoint WHERE as_of <= ?', (as_of,)).fetchone()[0]
+    start = checkpoint if checkpoint is not None else -2**63
+    # Replay from the live table and whichever archives the range reaches
+    replay = []
+    params = [checkpoint]
+    for table in movement_tables(conn, start, as_of):
+        replay.append(f'''
+            UNION ALL
+            SELECT product_key, to_location_key, qty
+            FROM {table}
+            WHERE to_location_key IS NOT NULL AND moved_at >= ? AND moved_at <= ?
+            UNION ALL
+            SELECT product_key, from_location_key, -qty
+            FROM {table}
+            WHERE from_location_key IS NOT NULL AND moved_at >= ? AND moved_at <= ?
+        ''')
+        params += [start, as_of, start, as_of]
+    return f'''
+        SELECT p.product_id, p.product_name,
+               l.location_id, l.location_name,
+               b.balance
+        FROM (
+            SELECT product_key, location_key, SUM(qty) as balance
+            FROM (
+                SELECT product_key, location_key, qty
+                FROM BalanceCheckpointLine
+                WHERE as_of = ?
+                {''.join(replay)}
+            )
+            GROUP BY product_key, location_key
+            HAVING SUM(qty) != 0
+        ) b
+        JOIN Product p ON b.product_key = p.product_key
+        JOIN Location l ON b.location_key = l.location_key
+        ORDER BY p.product_name, p.product_id, l.location_name, l.location_id
+    ''', params
+
+def compute_balances_as_of(conn, as_of):
+    """Non-zero balances including every movement with timestamp <= as_of"""
+    return conn.execute(*balances_as_of_query(conn, as_of)).fetchall()
+
+def invalidate_checkpoints(conn, moved_at):
+    """Drop checkpoints that a movement at `moved_at` (stored seconds) changes; runs in the caller's transaction"""
+    conn.execute('DELETE FROM BalanceCheckpointLine WHERE as_of > ?', (moved_at,))
+    conn.execute('DELETE FROM BalanceCheckpoint WHERE as_of > ?', (moved_at,))
+
+def write_checkpoint(conn, previous, as_of):
+    """Write the checkpoint at `as_of` from the one at `previous` (None: from the start).
+
+    Only the live table is replayed: every checkpoint from the archive
+    horizon on lies after all archived movements. Runs in the caller's
+    transaction.
+    """
+    start = previous if previous is not None else -2**63
+    conn.execute('''
+        INSERT INTO BalanceCheckpointLine (as_of, product_key, location_key, qty)
+        SELECT ?, product_key, location_key, SUM(qty)
+        FROM (
+            SELECT product_key, location_key, qty
+            FROM BalanceCheckpointLine
+            WHERE as_of = ?
+            UNION ALL
+            SELECT product_key, to_location_key, qty
+            FROM ProductMovement
+            WHERE to_location_key IS NOT NULL AND moved_at >= ? AND moved_at < ?
+            UNION ALL
+            SELECT product_key, from_location_key, -qty
+            FROM ProductMovement
+            WHERE from_location_key IS NOT NULL AND moved_at >= ? AND moved_at < ?
+        )
+        GROUP BY product_key, location_key
+        HAVING SUM(qty) != 0
+    ''', (as_of, previous, start, as_of, start, as_of))
+    conn.execute('INSERT INTO BalanceCheckpoint (as_of, created_at) VALUES (?, ?)',
+                 (as_of, datetime.now().strftime(TIMESTAMP_FORMAT)))
+
+def create_checkpoints(conn, until=None, interval_days=CHECKPOINT_INTERVAL_DAYS):
+    """Write checkpoints for every closed interval up to `until` (default: start of today).
+
+    Intervals start at midnight; `until` is a TIMESTAMP_FORMAT string.
+
+    Picks up after the latest existing checkpoint and commits each one on its
+    own, so an interrupted run resumes where it stopped. Intervals without
+    movements are skipped; as-of queries fall back to the older checkpoint and
+    find nothing to replay. Returns the number of checkpoints written.
+    """
+    if until is None:
+        until = datetime.now().strftime('%Y-%m-%d 00:00:00')
+    until = to_epoch(until)
+    step = timedelta(days=interval_days)
+    
+    previous = conn.execute('SELECT MAX(as_of) FROM BalanceCheckpoint').fetchone()[0]
+    if previous is None:
+        first = conn.execute('SELECT MIN(moved_at) FROM ProductMovement').fetchone()[0]
+        if first is None:
+            return 0
+        boundary = datetime.fromisoformat(from_epoch(first)[:10]) + step
+    else:
+        boundary = datetime.fromisoformat(from_epoch(previous)) + step
+    
+    written = 0
+    while to_epoch(boundary) <= until:
+        as_of = to_epoch(boundary)
+        start = previous if previous is not None else -2**63
+        boundary += step
+        changed = conn.execute('''
+            SELECT 1 FROM ProductMovement WHERE moved_at >= ? AND moved_at < ? LIMIT 1
+        ''', (start, as_of)).fetchone()
+        if not changed:
+            continue
+        
+        begin_write(conn)
+        # A backdated movement may have dropped checkpoints since `previous`
+        # was read, so build on whichever one still exists now
+        if conn.execute('SELECT 1 FROM BalanceCheckpoint WHERE as_of = ?', (as_of,)).fetchone() is None:
+            previous = conn.execute('SELECT MAX(as_of) FROM BalanceCheckpoint WHERE as_of < ?',
+                                    (as_of,)).fetchone()[0]
+            write_checkpoint(conn, previous, as_of)
+            written += 1
+        conn.commit()
+        previous = as_of
+    return written
+
+@app.cli.command('checkpoint-balances')
+@click.option('--interval-days', default=CHECKPOINT_INTERVAL_DAYS, show_default=True,
+              help='Days between checkpoints.')
+def checkpoint_balances_command(interval_days):
+    """Write balance checkpoints for closed periods (safe to re-run or interrupt)"""
+    init_db()
+    conn = open_db_connection()
+    written = create_checkpoints(conn, interval_days=interval_days)
+    conn.dispose()
+    click.echo(f'{written} checkpoint(s) written')
+
+# Movement archives
+# Closed months can be moved out of ProductMovement into one archive table per
+# month (MovementArchive_YYYY_MM), listed in the MovementArchive registry. The
+# archive job leaves a balance checkpoint at its horizon, the end of the newest
+# archived month. Current balances are that checkpoint plus the live table, so
+# everything before the horizon is read-only. Reads that reach back past the
+# horizon (listings, exports, as-of balances, lookups by ID) also read the
+# archive tables whose month they touch.
+ARCHIVE_KEEP_MONTHS = 12
+
+class ClosedPeriodError(sqlite3.IntegrityError):
+    """A write would change movement history in an archived period"""
+
+    def __init__(self, horizon):
+        super().__init__(f'Movements before {from_epoch(horizon)} are archived and read-only')
+        self.horizon = horizon
+
+def archive_horizon(conn):
+    """Stored seconds before which all movements are archived, or None"""
+    return conn.execute('SELECT MAX(end_at) FROM MovementArchive').fetchone()[0]
+
+def check_open_period(conn, moved_at):
+    """Raise ClosedPeriodError if `moved_at` falls in an archived period"""
+    horizon = archive_horizon(conn)
+    if horizon is not None and moved_at < horizon:
+        raise ClosedPeriodError(horizon)
+
+def movement_tables(conn, start=None, end=None):
+    """Tables that can hold movements with start <= moved_at <= end, newest first.
+
+    The live table always comes first, then each archive whose month overlaps
+    the range. Their periods do not overlap, so reading the tables in this
+    order reads movements in listing order.
+    """
+    tables = ['ProductMovement']
+    archives = conn.execute('SELECT table_name, start_at, end_at FROM MovementArchive ORDER BY start_at DESC')
+    for table_name, start_at, end_at in archives:
+        if (start is None or end_at > start) and (end is None or start_at <= end):
+            tables.append(table_name)
+    return tables
+
+def movement_range(filters, cursor=None):
+    """(start, end) bounds in stored seconds of a listing's dates and cursor; None is unbounded"""
+    start = end = None
+    date_from = parse_date(filters.get('date_from'))
+    if date_from:
+        start = to_epoch(date_from)
+    date_to = parse_date(filters.get('date_to'))
+    if date_to:
+        end = to_epoch(date_to + timedelta(days=1)) - 1
+    if cursor:
+        end = cursor[0] if end is None else min(end, cursor[0])
+    return start, end
+
+def list_movements(conn, filters, cursor=None, limit=None):
+    """One page of the movement listing; archives are only read once the live table runs out"""
+    movements = []
+    for table in movement_tables(conn, *movement_range(filters, cursor)):
+        remaining = limit - len(movements) if limit else None
+        movements += conn.execute(*build_movement_query(filters, cursor, remaining, table)).fetchall()
+        if limit and len(movements) >= limit:
+            break
+    return movements
+
+def iter_movements(conn, filters):
+    """Yield every movement matching the filters in listing order, live and archived"""
+    for table in movement_tables(conn, *movement_range(filters)):
+        yield from conn.execute(*build_movement_query(filters, table=table))
+
+def movements_exist(conn, sql, params):
+    """Run an EXISTS probe (with a {table} placeholder) on the live table, then each archive until one matches"""
+    return any(conn.execute(sql.format(table=table), params).fetchone()[0] for table in movement_tables(conn))
+
+def create_archive_table(conn, table):
+    """Create an empty archive table with ProductMovement's columns and listing indexes"""
+    conn.execute(f'''
+        CREATE TABLE {table} (
+            movement_key INTEGER PRIMARY KEY,
+            movement_id BLOB NOT NULL UNIQUE,
+            moved_at INTEGER NOT NULL,
+            product_key INTEGER NOT NULL,
+            from_location_key INTEGER,
+            to_location_key INTEGER,
+            qty INTEGER NOT NULL,
+            document_key INTEGER,
+            FOREIGN KEY (product_key) REFERENCES Product (product_key),
+            FOREIGN KEY (from_location_key) REFERENCES Location (location_key),
+            FOREIGN KEY (to_location_key) REFERENCES Location (location_key),
+            FOREIGN KEY (document_key) REFERENCES TransferDocument (document_key)
+        )
+    ''')
+    conn.execute(f'CREATE INDEX idx_{table}_moved_at ON {table} (moved_at)')
+    conn.execute(f'CREATE INDEX idx_{table}_product_moved_at ON {table} (product_key, moved_at)')
+    conn.execute(f'CREATE INDEX idx_{table}_from_moved_at ON {table} (from_location_key, moved_at)')
+    conn.execute(f'CREATE INDEX idx_{table}_to_moved_at ON {table} (to_location_key, moved_at)')
+    conn.execute(f'CREATE INDEX idx_{table}_document ON {table} (document_key) WHERE document_key IS NOT NULL')
+
+def months_ago(months):
+    """Midnight on the first day of the month `months` before the current one"""
+    today = datetime.now()
+    year, month = divmod(today.year * 12 + today.month - 1 - months, 12)
+    return datetime(year, month + 1, 1)
+
+def archive_movements(conn, before):
+    """Archive, oldest first, every month of history that ends by `before`; returns the months archived.
+
+    Each month is one transaction: the checkpoint at the month's end is
+    written if missing, then its movements are copied into a new archive
+    table and deleted from ProductMovement. Safe to interrupt and re-run.
+    """
+    before = to_epoch(before)
+    archived = 0
+    while True:
+        begin_write(conn)
+        first = conn.execute('SELECT MIN(moved_at) FROM ProductMovement').fetchone()[0]
+        if first is None:
+            conn.rollback()
+            break
+        month = datetime.fromisoformat(from_epoch(first)[:7] + '-01')
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        start_at, end_at = to_epoch(month), to_epoch(next_month)
+        if end_at > before:
+            conn.rollback()
+            break
+        
+        # Every archived movement is before the horizon, so the checkpoint
+        # there must exist before the movements leave the live table
+        if conn.execute('SELECT 1 FROM BalanceCheckpoint WHERE as_of = ?', (end_at,)).fetchone() is None:
+            previous = conn.execute('SELECT MAX(as_of) FROM BalanceCheckpoint WHERE as_of < ?',
+                                    (end_at,)).fetchone()[0]
+            write_checkpoint(conn, previous, end_at)
+        
+        table = f'MovementArchive_{month:%Y_%m}'
+        create_archive_table(conn, table)
+        moved = conn.execute(f'''
+            INSERT INTO {table} (movement_key, movement_id, moved_at, product_key, from_location_key, to_location_key,
+                                 qty, document_key)
+            SELECT movement_key, movement_id, moved_at, product_key, from_location_key, to_location_key,
+                   qty, document_key
+            FROM ProductMovement WHERE moved_at < ?
+        ''', (end_at,)).rowcount
+        conn.execute('DELETE FROM ProductMovement WHERE moved_at < ?', (end_at,))
+        conn.execute('''
+            INSERT INTO MovementArchive (start_at, end_at, table_name, movements, archived_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (start_at, end_at, table, moved, datetime.now().strftime(TIMESTAMP_FORMAT)))
+        conn.commit()
+        archived += 1
+    return archived
+
+@app.cli.command('archive-movements')
+@click.option('--keep-months', default=ARCHIVE_KEEP_MONTHS, show_default=True,
+              help='Whole months to keep live besides the current one.')
+def archive_movements_command(keep_months):
+    """Move closed months of movement history into per-month archive tables"""
+    init_db()
+    conn = open_db_connection()
+    archived = archive_movements(conn, months_ago(keep_months))
+    conn.dispose()
+    click.echo(f'{archived} month(s) archived')
+
+# Movement analytics
+# DailyMovement rolls movements up into one row per product, location and day
+# (days since 1970-01-01 in stored time) with inbound and outbound totals.
+# Every movement write updates its row in the same transaction, so analytics
+# read a bounded window of rollup rows however long the history is. Weekly and
+# monthly buckets are summed from the daily rows. A transfer counts as outbound
+# at its source and inbound at its destination.
+SECONDS_PER_DAY = 86400
+# Floor division, so movements before 1970 also land on the right day
+DAY_SQL = f'(moved_at - (moved_at % {SECONDS_PER_DAY} + {SECONDS_PER_DAY}) % {SECONDS_PER_DAY}) / {SECONDS_PER_DAY}'
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_MAX_DAYS = 731
+ANALYTICS_DEFAULT_BUCKET = 'week'
+# Weeks start on Monday
+ANALYTICS_BUCKETS = {
+    'day': "date(day * 86400, 'unixepoch')",
+    'week': "date(day * 86400, 'unixepoch', 'weekday 0', '-6 days')",
+    'month': "date(day * 86400, 'unixepoch', 'start of month')",
+}
+
+def daily_deltas(product_key, from_location_key, to_location_key, moved_at, qty, deltas=None):
+    """Add one movement to a {(product_key, location_key, day): [inbound, outbound]} mapping"""
+    if deltas is None:
+        deltas = {}
+    day = moved_at // SECONDS_PER_DAY
+    if to_location_key:
+        deltas.setdefault((product_key, to_location_key, day), [0, 0])[0] += qty
+    if from_location_key:
+        deltas.setdefault((product_key, from_location_key, day), [0, 0])[1] += qty
+    return deltas
+
+def apply_daily_deltas(conn, deltas):
+    """Fold a daily_deltas mapping into DailyMovement; runs in the caller's transaction"""
+    rows = [(*key, inbound, outbound) for key, (inbound, outbound) in deltas.items() if inbound or outbound]
+    conn.executemany('''
+        INSERT INTO DailyMovement (product_key, location_key, day, inbound, outbound) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (product_key, location_key, day) DO UPDATE
+        SET inbound = inbound + excluded.inbound, outbound = outbound + excluded.outbound
+    ''', rows)
+    # A reversal can empty a day; drop it the way StockBalance drops zero stock
+    conn.executemany('''
+        DELETE FROM DailyMovement
+        WHERE product_key = ? AND location_key = ? AND day = ? AND inbound = 0 AND outbound = 0
+    ''', [row[:3] for row in rows if row[3] < 0 or row[4] < 0])
+
+def daily_movements_query(conn):
+    """SQL computing DailyMovement's rows from live and archived movements in one grouped pass"""
+    branches = ' UNION ALL '.join(f'''
+        SELECT product_key, to_location_key as location_key, moved_at, qty as inbound, 0 as outbound
+        FROM {table} WHERE to_location_key IS NOT NULL
+        UNION ALL
+        SELECT product_key, from_location_key, moved_at, 0, qty
+        FROM {table} WHERE from_location_key IS NOT NULL
+    ''' for table in movement_tables(conn))
+    return f'''
+        SELECT product_key, location_key, {DAY_SQL} as day, SUM(inbound) as inbound, SUM(outbound) as outbound
+        FROM ({branches})
+        GROUP BY 1, 2, 3
+    '''
+
+def rebuild_daily_movements(conn):
+    """Recompute DailyMovement from movement history; returns its row count.
+
+    The caller commits.
+    """
+    conn.execute('DELETE FROM DailyMovement')
+    return conn.execute(f'''
+        INSERT INTO DailyMovement (product_key, location_key, day, inbound, outbound)
+        {daily_movements_query(conn)}
+    ''').rowcount
+
+@app.cli.command('rebuild-analytics')
+def rebuild_analytics_command():
+    """Recompute the DailyMovement rollup from movement history"""
+    init_db()
+    conn = sqlite3.connect(DATABASE)
+    rows = rebuild_daily_movements(conn)
+    bump_generation(conn, DATA)
+    conn.commit()
+    conn.close()
+    click.echo(f'DailyMovement rebuilt: {rows} rows')
+
+def parse_analytics_days(value):
+    """Window length in days from a query parameter; the default when empty, None when invalid"""
+    if not value:
+        return ANALYTICS_DEFAULT_DAYS
+    try:
+        days = int(value)
+    except ValueError:
+        return None
+    return days if 1 <= days <= ANALYTICS_MAX_DAYS else None
+
+def analytics_window(days):
+    """(first_day, last_day) of the `days` days ending today, as day numbers"""
+    last_day = to_epoch(datetime.now()) // SECONDS_PER_DAY
+    return last_day - days + 1, last_day
+
+def rollup_key_filter(product_id=None, location_id=None):
+    """SQL conditions (each starting with AND) and params narrowing rollup or balance rows by text ID"""
+    sql = ''
+    params = []
+    if product_id:
+        sql += ' AND product_key = (SELECT product_key FROM Product WHERE product_id = ?)'
+        params.append(product_id)
+    if location_id:
+        sql += ' AND location_key = (SELECT location_key FROM Location WHERE location_id = ?)'
+        params.append(location_id)
+    return sql, params
+
+def analytics_query(days, product_id=None, location_id=None):
+    """SQL and params for window totals and current stock per product/location"""
+    first_day, last_day = analytics_window(days)
+    key_filter, key_params = rollup_key_filter(product_id, location_id)
+    return f'''
+        SELECT p.product_id, p.product_name,
+               l.location_id, l.location_name,
+               a.inbound, a.outbound, a.balance
+        FROM (
+            SELECT product_key, location_key,
+                   SUM(inbound) as inbound, SUM(outbound) as outbound, SUM(balance) as balance
+            FROM (
+                SELECT product_key, location_key, inbound, outbound, 0 as balance
+                FROM DailyMovement
+                WHERE day >= ? AND day <= ?{key_filter}
+                UNION ALL
+                SELECT product_key, location_key, 0, 0, qty
+                FROM StockBalance
+                WHERE qty != 0{key_filter}
+            )
+            GROUP BY product_key, location_key
+        ) a
+        JOIN Product p ON a.product_key = p.product_key
+        JOIN Location l ON a.location_key = l.location_key
+        ORDER BY p.product_name, p.product_id, l.location_name, l.location_id
+    ''', [first_day, last_day, *key_params, *key_params]
+
+def movement_series_query(days, bucket, product_id=None, location_id=None):
+    """SQL and params for inbound/outbound totals per day, week or month of the window"""
+    first_day, last_day = analytics_window(days)
+    key_filter, key_params = rollup_key_filter(product_id, location_id)
+    return f'''
+        SELECT {ANALYTICS_BUCKETS[bucket]} as period, SUM(inbound) as inbound, SUM(outbound) as outbound
+        FROM DailyMovement
+        WHERE day >= ? AND day <= ?{key_filter}
+        GROUP BY period
+        ORDER BY period
+    ''', [first_day, last_day, *key_params]
+
+def compute_analytics(conn, days, product_id=None, location_id=None):
+    """Per product/location window totals with velocity, turnover and days of stock remaining.
+
+    Velocity is outbound units per day over the window. Turnover is window
+    outbound over average stock, estimated as the mean of the stock at the
+    start of the window and now. Days of stock is current stock over velocity.
+    Both are None where they are undefined.
+    """
+    analytics = []
+    for row in conn.execute(*analytics_query(days, product_id, location_id)):
+        inbound, outbound, balance = row['inbound'], row['outbound'], row['balance']
+        velocity = outbound / days
+        average_stock = balance - (inbound - outbound) / 2
+        analytics.append({
+            **dict(row),
+            'daily_outbound': round(velocity, 2),
+            'turnover': round(outbound / average_stock, 2) if average_stock > 0 else None,
+            'days_of_stock': round(balance / velocity, 1) if velocity and balance > 0 else None,
+        })
+    return analytics
+
+def compute_movement_series(conn, days, bucket, product_id=None, location_id=None):
+    """Inbound/outbound totals per bucket of the window, oldest first"""
+    return [dict(row) for row in conn.execute(*movement_series_query(days, bucket, product_id, location_id))]
+
+@app.route('/analytics')
+def analytics():
+    """Movement totals per bucket, turnover and days of stock over a recent window"""
+    product_id = request.args.get('product_id', '')
+    location_id = request.args.get('location_id', '')
+    days = parse_analytics_days(request.args.get('days'))
+    if days is None:
+        flash(f'Days must be a whole number from 1 to {ANALYTICS_MAX_DAYS}!', 'error')
+        days = ANALYTICS_DEFAULT_DAYS
+    bucket = request.args.get('bucket') or ANALYTICS_DEFAULT_BUCKET
+    if bucket not in ANALYTICS_BUCKETS:
+        flash('Invalid bucket!', 'error')
+        bucket = ANALYTICS_DEFAULT_BUCKET
+    
+    conn, snapshot_at = get_report_connection()
+    rows = compute_analytics(conn, days, product_id, location_id)
+    series = compute_movement_series(conn, days, bucket, product_id, location_id)
+    conn.close()
+    # The filter lists come from the live database, whose reference cache they share
+    conn = get_db_connection()
+    products, locations = get_reference_data(conn)
+    conn.close()
+    return render_template('analytics.html', rows=rows, series=series, days=days, bucket=bucket,
+                           product_id=product_id, location_id=location_id,
+                           products=products, locations=locations, snapshot_at=snapshot_at)
+
+# Integrity checks
+# verify-integrity checks an existing database in bulk: SQLite's own structure
+# and foreign key checks, then every derived table (balances, the analytics
+# rollup, transfer headers, the archive registry) against the movements it is
+# derived from. It leaves the database unchanged; repairs are left to the
+# rebuild commands.
+
+def verify_integrity(conn, full=False):
+    """Check the database and everything derived from movement history; returns a list of problems"""
+    problems = []
+    pragma = 'integrity_check' if full else 'quick_check'
+    problems += [f'{pragma}: {message}' for (message,) in conn.execute(f'PRAGMA {pragma}') if message != 'ok']
+    for table, rowid, parent, _ in conn.execute('PRAGMA foreign_key_check').fetchall():
+        # WITHOUT ROWID tables report no rowid
+        row = f'{table} row {rowid}' if rowid is not None else table
+        problems.append(f'{row}: refers to a missing {parent} row')
+    
+    for product_id, location_id, stored_qty, expected_qty in balance_drift(conn):
+        problems.append(f'StockBalance {product_id} @ {location_id}: stored {stored_qty}, expected {expected_qty}')
+    
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    missing_tables = False
+    archives = conn.execute('SELECT table_name, start_at, end_at, movements FROM MovementArchive').fetchall()
+    for table, start_at, end_at, movements in archives:
+        if table not in existing:
+            problems.append(f'{table}: listed in MovementArchive but missing')
+            missing_tables = True
+            continue
+        count, outside = conn.execute(f'''
+            SELECT COUNT(*), COUNT(*) FILTER (WHERE moved_at < ? OR moved_at >= ?) FROM {table}
+        ''', (start_at, end_at)).fetchone()
+        if count != movements:
+            problems.append(f'{table}: {count} movements, MovementArchive says {movements}')
+        if outside:
+            problems.append(f'{table}: {outside} movement(s) outside {from_epoch(start_at)} - {from_epoch(end_at)}')
+    horizon = archive_horizon(conn)
+    if horizon is not None:
+        early = conn.execute('SELECT COUNT(*) FROM ProductMovement WHERE moved_at < ?', (horizon,)).fetchone()[0]
+        if early:
+            problems.append(f'ProductMovement: {early} movement(s) before the archive horizon {from_epoch(horizon)}')
+    if missing_tables:
+        # The remaining checks read every archive table
+        return problems
+    
+    expected = daily_movements_query(conn)
+    stored = 'SELECT product_key, location_key, day, inbound, outbound FROM DailyMovement'
+    missing, extra = conn.execute(f'''
+        SELECT (SELECT COUNT(*) FROM ({expected} EXCEPT {stored})),
+               (SELECT COUNT(*) FROM ({stored} EXCEPT {expected}))
+    ''').fetchone()
+    if missing or extra:
+        problems.append(f'DailyMovement: {missing} row(s) missing or wrong, {extra} row(s) unexpected; '
+                        'run rebuild-analytics')
+    
+    unused = ' AND '.join(f'NOT EXISTS (SELECT 1 FROM {table} WHERE document_key = d.document_key)'
+                          for table in movement_tables(conn))
+    for (document,) in conn.execute(f'SELECT document_key FROM TransferDocument d WHERE {unused}'):
+        problems.append(f'TransferDocument {document}: no lines')
+    
+    return problems
+
+@app.cli.command('verify-integrity')
+@click.option('--full', is_flag=True, help='Run PRAGMA integrity_check instead of the faster quick_check.')
+def verify_integrity_command(full):
+    """Check foreign keys, balances, rollups and archives; exits with status 1 on any problem"""
+    init_db()
+    conn = sqlite3.connect(DATABASE)
+    problems = verify_integrity(conn, full)
+    conn.close()
+    
+    for problem in problems:
+        click.echo(problem)
+    click.echo(f'{len(problems)} problem(s) found')
+    if problems:
+        raise SystemExit(1)
+
+# Balance report
+@app.route('/balance-report')
+@cached_response(report=True)
+def balance_report():
+    """Generate balance report, optionally as of a past date (?as_of=YYYY-MM-DD[ HH:MM:SS])"""
+    as_of = None
+    if request.args.get('as_of'):
+        as_of = parse_as_of(request.args['as_of'])
+        if as_of is None:
+            flash('Invalid as-of date!', 'error')
+    
+    conn, snapshot_at = get_report_connection()
+    if as_of:
+        rows = compute_balances_as_of(conn, as_of)
+    else:
+        rows = get_stock_balances(conn)
+    balances = [dict(row) for row in rows]
+    conn.close()
+    return render_template('balance_report.html', balances=balances, as_of=as_of, snapshot_at=snapshot_at)
+
+# Streaming exports
+# Rows go out as they are read from the cursor, so memory stays flat however
+# large the export is, and the header is sent before the query starts.
+EXPORT_COLUMNS = {
+    'balances': ['product_id', 'product_name', 'location_id', 'location_name', 'balance'],
+    'movements': ['movement_id', 'timestamp', 'product_id', 'product_name',
+                  'from_location', 'from_location_name', 'to_location', 'to_location_name', 'qty', 'document'],
+}
+# CSV output is flushed to the client in chunks of about this many bytes
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+def balance_export_query(conn, args):
+    """SQL and params for a balance export; args holds as_of or the product/location filters"""
+    as_of = parse_as_of(args.get('as_of'))
+    if as_of:
+        return balances_as_of_query(conn, as_of)
+    return stock_balance_query(args.get('product_id'), args.get('location_id'))
+
+def iter_export_rows(conn, kind, args):
+    """Yield the export's rows as tuples in EXPORT_COLUMNS order"""
+    columns = EXPORT_COLUMNS[kind]
+    if kind == 'movements':
+        rows = iter_movements(conn, {key: args.get(key, '') for key in MOVEMENT_FILTERS})
+    else:
+        rows = conn.execute(*balance_export_query(conn, args))
+    for row in rows:
+        yield tuple(row[column] for column in columns)
+
+def iter_csv_chunks(kind, rows):
+    """Yield CSV text: the header at once, then rows in EXPORT_CHUNK_SIZE pieces"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS[kind])
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@functools.cache
+def xlsx_available():
+    """Whether openpyxl is installed; XLSX export is optional"""
+    # Looked up without importing it: the import alone costs more than 100 ms
+    # of every worker's startup, for a feature few requests use
+    return importlib.util.find_spec('openpyxl') is not None
+
+def write_xlsx(kind, rows, path):
+    """Write an export to an XLSX file using openpyxl's write-only (streaming) mode"""
+    from openpyxl import Workbook
+    
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(kind)
+    sheet.append(EXPORT_COLUMNS[kind])
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+def export_filename(kind, extension):
+    """Download name such as balances-20240131-235959.csv"""
+    return f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{extension}"
+
+@app.route('/export/<kind>')
+def export(kind):
+    """Download balances or movement history as CSV (streamed) or XLSX"""
+    if kind not in EXPORT_COLUMNS:
+        flash('Unknown export!', 'error')
+        return redirect(url_for('index'))
+    back = url_for('balance_report' if kind == 'balances' else 'view_movements')
+    
+    if request.args.get('format') == 'xlsx':
+        if not xlsx_available():
+            flash('XLSX export requires the openpyxl package!', 'error')
+            return redirect(back)
+        # XLSX is a zip archive and cannot be sent before it is complete; the
+        # write-only workbook still keeps memory flat while it is built
+        conn, _ = get_report_connection()
+        output = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False)
+        output.close()
+        write_xlsx(kind, iter_export_rows(conn, kind, request.args), output.name)
+        conn.close()
+        response = send_file(output.name, as_attachment=True, download_name=export_filename(kind, 'xlsx'))
+        response.call_on_close(lambda: os.remove(output.name))
+        return response
+    
+    # Opened before the response starts, so its X-Snapshot-At header is known
+    conn, _ = get_report_connection()
+    
+    def generate():
+        yield from iter_csv_chunks(kind, iter_export_rows(conn, kind, request.args))
+        conn.close()
+    
+    response = app.response_class(stream_with_context(generate()), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename={export_filename(kind, "csv")}'
+    return response
+
+@app.cli.command('export')
+@click.argument('kind', type=click.Choice(list(EXPORT_COLUMNS)))
+@click.option('--format', 'export_format', type=click.Choice(['csv', 'xlsx']), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Output file; CSV goes to stdout when omitted.')
+@click.option('--as-of', help='Balances as of YYYY-MM-DD[ HH:MM:SS].')
+@click.option('--product-id', help='Only this product.')
+@click.option('--location-id', help='Only this location.')
+@click.option('--direction', type=click.Choice(list(MOVEMENT_DIRECTIONS)), help='Only this movement type.')
+@click.option('--date-from', help='Movements on or after YYYY-MM-DD.')
+@click.option('--date-to', help='Movements on or before YYYY-MM-DD.')
+def export_command(kind, export_format, output, **args):
+    """Export balances or movement history as CSV or XLSX"""
+    args = {key: value for key, value in args.items() if value}
+    init_db()
+    conn = open_db_connection()
+    rows = iter_export_rows(conn, kind, args)
+    
+    if export_format == 'xlsx':
+        if not xlsx_available():
+            raise click.ClickException('XLSX export requires the openpyxl package')
+        if not output:
+            raise click.ClickException('--output is required for XLSX')
+        write_xlsx(kind, rows, output)
+    elif output:
+        with open(output, 'w', newline='', encoding='utf-8') as f:
+            for chunk in iter_csv_chunks(kind, rows):
+                f.write(chunk)
+    else:
+        for chunk in iter_csv_chunks(kind, rows):
+            click.echo(chunk, nl=False)
+    conn.dispose()
+
+# Background jobs
+# Slow reports and exports can be queued in the Job table instead of being built
+# on the request path. Workers (threads started by serve.py, or
+# `flask --app app run-jobs` in its own process) claim queued jobs one at a time
+# with a conditional update, so any number of them can share the queue. Results
+# are written to files next to the database and downloaded once the job is done.
+# A running job's worker refreshes its heartbeat; a job whose heartbeat stops
+# is queued again, and the run that was presumed dead can no longer finish it.
+JOB_FORMATS = ('csv', 'xlsx')
+# Seconds an idle worker waits before looking at the queue again
+JOB_POLL_INTERVAL = 1.0
+# Seconds between heartbeats of a running job
+JOB_HEARTBEAT_INTERVAL = 30
+# A running job without a heartbeat for this long has lost its worker and is queued again
+JOB_STALE_SECONDS = 300
+# Finished jobs and their result files are deleted after this many days
+JOB_RETENTION_DAYS = 7
+# Seconds between an idle worker's stale-job and retention sweeps
+JOB_HOUSEKEEPING_INTERVAL = 300
+
+def job_result_dir():
+    """Directory holding job result files, next to the database"""
+    return os.path.join(os.path.dirname(os.path.abspath(DATABASE)), 'job_results')
+
+def enqueue_job(conn, kind, export_format, params):
+    """Queue an export of `kind` with its args; returns the job ID. The caller commits."""
+    job_id = str(uuid.uuid4())
+    conn.execute('''
+        INSERT INTO Job (job_id, kind, format, params, status, created_at)
+        VALUES (?, ?, ?, ?, 'queued', ?)
+    ''', (job_id, kind, export_format, json.dumps(params), datetime.now().strftime(TIMESTAMP_FORMAT)))
+    return job_id
+
+def get_job(conn, job_id):
+    """One job row, or None"""
+    return conn.execute('SELECT * FROM Job WHERE job_id = ?', (job_id,)).fetchone()
+
+def claim_job(conn):
+    """Mark the oldest queued job as running and return it, or None if the queue is empty"""
+    # Polling an empty queue must not take the write lock from interactive writers
+    if conn.execute("SELECT 1 FROM Job WHERE status = 'queued' LIMIT 1").fetchone() is None:
+        return None
+    begin_write(conn)
+    now = datetime.now().strftime(TIMESTAMP_FORMAT)
+    job = conn.execute('''
+        UPDATE Job SET status = 'running', started_at = ?, heartbeat_at = ?, run_id = ?
+        WHERE job_id = (SELECT job_id FROM Job WHERE status = 'queued' ORDER BY created_at, rowid LIMIT 1)
+        RETURNING job_id, kind, format, params, run_id
+    ''', (now, now, str(uuid.uuid4()))).fetchone()
+    conn.commit()
+    return job
+
+def finish_job(conn, job, result_path=None, error=None, snapshot_at=None):
+    """Record a job run's result file, or its error; returns False if the job was requeued meanwhile"""
+    begin_write(conn)
+    finished = conn.execute('''
+        UPDATE Job SET status = ?, finished_at = ?, result_path = ?, error = ?, snapshot_at = ?
+        WHERE job_id = ? AND run_id = ? AND status = 'running'
+    ''', ('failed' if error else 'done', datetime.now().strftime(TIMESTAMP_FORMAT), result_path, error,
+          snapshot_at, job['job_id'], job['run_id'])).rowcount
+    conn.commit()
+    return finished > 0
+
+def beat_job(job, stop):
+    """Refresh a running job's heartbeat every JOB_HEARTBEAT_INTERVAL until `stop` is set"""
+    conn = open_db_connection()
+    try:
+        while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                begin_write(conn)
+                conn.execute('UPDATE Job SET heartbeat_at = ? WHERE job_id = ? AND run_id = ?',
+                             (datetime.now().strftime(TIMESTAMP_FORMAT), job['job_id'], job['run_id']))
+                conn.commit()
+            except sqlite3.OperationalError:
+                # A missed beat is harmless; JOB_STALE_SECONDS allows for several
+                conn.rollback()
+                app.logger.warning('Heartbeat of job %s failed', job['job_id'], exc_info=True)
+    finally:
+        conn.dispose()
+
+def run_job(conn, job):
+    """Build a claimed job's export file and record the outcome"""
+    os.makedirs(job_result_dir(), exist_ok=True)
+    path = os.path.join(job_result_dir(), f"{job['job_id']}.{job['format']}")
+    # Each run writes its own temporary file, so a result file is always
+    # complete even if a requeued job is briefly run twice
+    partial = f"{path}.{job['run_id']}.part"
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=beat_job, args=(job, stop), name='job-heartbeat', daemon=True)
+    heartbeat.start()
+    source, snapshot_at = conn, None
+    try:
+        if REPORT_SNAPSHOT_SECONDS:
+            # Exports read the reporting snapshot, as the /export route does
+            taken_at, snapshot_path = current_report_snapshot()
+            source = open_report_snapshot(snapshot_path)
+            snapshot_at = datetime.fromtimestamp(taken_at).strftime(TIMESTAMP_FORMAT)
+        rows = iter_export_rows(source, job['kind'], json.loads(job['params']))
+        if job['format'] == 'xlsx':
+            write_xlsx(job['kind'], rows, partial)
+        else:
+            with open(partial, 'w', newline='', encoding='utf-8') as f:
+                for chunk in iter_csv_chunks(job['kind'], rows):
+                    f.write(chunk)
+        conn.rollback()
+        os.replace(partial, path)
+    except Exception as e:
+        conn.rollback()
+        app.logger.exception('Job %s failed', job['job_id'])
+        if os.path.exists(partial):
+            os.remove(partial)
+        finish_job(conn, job, error=str(e) or type(e).__name__)
+        return
+    finally:
+        if source is not conn:
+            source.dispose()
+        stop.set()
+        heartbeat.join()
+    if not finish_job(conn, job, result_path=path, snapshot_at=snapshot_at):
+        app.logger.warning('Job %s was requeued while this run was still working on it', job['job_id'])
+
+def requeue_stale_jobs(conn):
+    """Queue again jobs whose worker stopped sending heartbeats; returns how many"""
+    cutoff = (datetime.now() - timedelta(seconds=JOB_STALE_SECONDS)).strftime(TIMESTAMP_FORMAT)
+    begin_write(conn)
+    requeued = conn.execute('''
+        UPDATE Job SET status = 'queued', started_at = NULL, heartbeat_at = NULL, run_id = NULL
+        WHERE status = 'running' AND heartbeat_at < ?
+    ''', (cutoff,)).rowcount
+    conn.commit()
+    return requeued
+
+def purge_jobs(conn, retention_days=JOB_RETENTION_DAYS):
+    """Delete finished jobs older than the retention period and their result files"""
+    cutoff = (datetime.now() - timedelta(days=retention_days)).strftime(TIMESTAMP_FORMAT)
+    begin_write(conn)
+    old = conn.execute('''
+        DELETE FROM Job WHERE status IN ('done', 'failed') AND finished_at < ?
+        RETURNING result_path
+    ''', (cutoff,)).fetchall()
+    conn.commit()
+    for (path,) in old:
+        if path and os.path.exists(path):
+            os.remove(path)
+    return len(old)
+
+def run_job_worker(stop=None, poll_interval=JOB_POLL_INTERVAL):
+    """Work through the job queue until `stop` (a threading.Event) is set"""
+    stop = stop or threading.Event()
+    conn = open_db_connection()
+    housekeeping_due = 0
+    try:
+        while not stop.is_set():
+            job = claim_job(conn)
+            if job is not None:
+                run_job(conn, job)
+                continue
+            # Housekeeping only while idle, so it never delays a queued job
+            if time.monotonic() >= housekeeping_due:
+                requeue_stale_jobs(conn)
+                purge_jobs(conn)
+                housekeeping_due = time.monotonic() + JOB_HOUSEKEEPING_INTERVAL
+            stop.wait(poll_interval)
+    finally:
+        conn.dispose()
+
+def start_job_worker(stop=None):
+    """Run a job worker in a daemon thread of this process; returns the thread"""
+    worker = threading.Thread(target=run_job_worker, args=(stop,), name='job-worker', daemon=True)
+    worker.start()
+    return worker
+
+@app.cli.command('run-jobs')
+@click.option('--poll-interval', default=JOB_POLL_INTERVAL, show_default=True,
+              help='Seconds to wait between looks at an empty queue.')
+def run_jobs_command(poll_interval):
+    """Work through queued background jobs until interrupted"""
+    init_db()
+    click.echo('Waiting for jobs (Ctrl+C to stop)')
+    try:
+        run_job_worker(poll_interval=poll_interval)
+    except KeyboardInterrupt:
+        pass
+
+# JSON API (v1)
+API_PREFIX = '/api/v1'
+# Responses at least this large are gzipped for clients that accept it
+API_GZIP_MIN_SIZE = 1024
+API_DEFAULT_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+def api_response(payload, status=200):
+    """Serialize payload as JSON, with ETag/If-None-Match and gzip for GET responses"""
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    response = app.response_class(body, status=status, mimetype='application/json')
+    if status != 200 or request.method != 'GET':
+        return response
+    
+    use_gzip = len(body) >= API_GZIP_MIN_SIZE and 'gzip' in request.accept_encodings
+    etag = hashlib.sha1(body).hexdigest()
+    # The gzipped body is a different representation, so it gets its own tag
+    response.set_etag(f'{etag}-gzip' if use_gzip else etag)
+    response.vary.add('Accept-Encoding')
+    response.make_conditional(request)
+    if use_gzip and response.status_code == 200:
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def api_error(message, status):
+    """JSON error response"""
+    return api_response({'error': message}, status)
+
+def api_payload():
+    """Request JSON body as a dict; empty when missing or not an object"""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+def parse_movement_payload(data):
+    """Validate movement fields from a JSON body; returns (values, error)"""
+    for field in ('product_id', 'from_location', 'to_location'):
+        if data.get(field) is not None and not isinstance(data[field], str):
+            return None, f'{field} must be a string'
+    product_id = data.get('product_id') or None
+    from_location = data.get('from_location') or None
+    to_location = data.get('to_location') or None
+    qty = data.get('qty')
+    
+    if not product_id or not isinstance(qty, int) or isinstance(qty, bool) or qty <= 0:
+        return None, 'product_id and a positive integer qty are required'
+    if not from_location and not to_location:
+        return None, 'Either from_location or to_location must be specified'
+    return (product_id, from_location, to_location, qty), None
+
+# Products
+@app.route(f'{API_PREFIX}/products', methods=['GET'])
+def api_list_products():
+    """List products"""
+    conn = get_db_connection()
+    products = get_reference_data(conn)[0]
+    conn.close()
+    return api_response({'products': [dict(row) for row in products]})
+
+@app.route(f'{API_PREFIX}/products', methods=['POST'])
+def api_create_product():
+    """Create a product"""
+    data = api_payload()
+    if not data.get('product_id') or not data.get('product_name'):
+        return api_error('product_id and product_name are required', 400)
+    
+    conn = get_db_connection()
+    try:
+        conn.execute('INSERT INTO Product (product_id, product_name, description) VALUES (?, ?, ?)',
+                     (data['product_id'], data['product_name'], data.get('description')))
+        bump_generation(conn, REFERENCE_DATA, DATA)
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.close()
+        return api_error('Product ID already exists', 409)
+    product = conn.execute(f'{PRODUCT_SELECT_SQL} WHERE product_id = ?', (data['product_id'],)).fetchone()
+    conn.close()
+    return api_response(dict(product), 201)
+
+@app.route(f'{API_PREFIX}/products/<product_id>', methods=['GET'])
+def api_get_product(product_id):
+    """Get one product"""
+    conn = get_db_connection()
+    product = conn.execute(f'{PRODUCT_SELECT_SQL} WHERE product_id = ?', (product_id,)).fetchone()
+    conn.close()
+    if product is None:
+        return api_error('Product not found', 404)
+    return api_response(dict(product))
+
+@app.route(f'{API_PREFIX}/products/<product_id>', methods=['PUT'])
+def api_update_product(product_id):
+    """Update a product's name and description"""
+    data = api_payload()
+    if not data.get('product_name'):
+        return api_error('product_name is required', 400)
+    
+    conn = get_db_connection()
+    updated = conn.execute('UPDATE Product SET product_name = ?, description = ? WHERE product_id = ?',
+                           (data['product_name'], data.get('description'), product_id)).rowcount
+    if updated:
+        bump_generation(conn, REFERENCE_DATA, DATA)
+    conn.commit()
+    product = conn.execute(f'{PRODUCT_SELECT_SQL} WHERE product_id = ?', (product_id,)).fetchone()
+    conn.close()
+    if not updated:
+        return api_error('Product not found', 404)
+    return api_response(dict(product))
+
+@app.route(f'{API_PREFIX}/products/<product_id>', methods=['DELETE'])
+def api_delete_product(product_id):
+    """Delete a product that has no movements"""
+    conn = get_db_connection()
+    try:
+        deleted = remove_product(conn, product_id)
+    except sqlite3.IntegrityError:
+        conn.close()
+        return api_error('Cannot delete product with existing movements', 409)
+    conn.commit()
+    conn.close()
+    if not deleted:
+        return api_error('Product not found', 404)
+    return '', 204
+
+# Locations
+@app.route(f'{API_PREFIX}/locations', methods=['GET'])
+def api_list_locations():
+    """List locations"""
+    conn = get_db_connection()
+    locations = get_reference_data(conn)[1]
+    conn.close()
+    return api_response({'locations': [dict(row) for row in locations]})
+
+@app.route(f'{API_PREFIX}/locations', methods=['POST'])
+def api_create_location():
+    """Create a location"""
+    data = api_payload()
+    if not data.get('location_id') or not data.get('location_name'):
+        return api_error('location_id and location_name are required', 400)
+    
+    conn = get_db_connection()
+    try:
+        conn.execute('INSERT INTO Location (location_id, location_name, address) VALUES (?, ?, ?)',
+                     (data['location_id'], data['location_name'], data.get('address')))
+        bump_generation(conn, REFERENCE_DATA, DATA)
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.close()
+        return api_error('Location ID already exists', 409)
+    location = conn.execute(f'{LOCATION_SELECT_SQL} WHERE location_id = ?', (data['location_id'],)).fetchone()
+    conn.close()
+    return api_response(dict(location), 201)
+
+@app.route(f'{API_PREFIX}/locations/<location_id>', methods=['GET'])
+def api_get_location(location_id):
+    """Get one location"""
+    conn = get_db_connection()
+    location = conn.execute(f'{LOCATION_SELECT_SQL} WHERE location_id = ?', (location_id,)).fetchone()
+    conn.close()
+    if location is None:
+        return api_error('Location not found', 404)
+    return api_response(dict(location))
+
+@app.route(f'{API_PREFIX}/locations/<location_id>', methods=['PUT'])
+def api_update_location(location_id):
+    """Update a location's name and address"""
+    data = api_payload()
+    if not data.get('location_name'):
+        return api_error('location_name is required', 400)
+    
+    conn = get_db_connection()
+    updated = conn.execute('UPDATE Location SET location_name = ?, address = ? WHERE location_id = ?',
+                           (data['location_name'], data.get('address'), location_id)).rowcount
+    if updated:
+        bump_generation(conn, REFERENCE_DATA, DATA)
+    conn.commit()
+    location = conn.execute(f'{LOCATION_SELECT_SQL} WHERE location_id = ?', (location_id,)).fetchone()
+    conn.close()
+    if not updated:
+        return api_error('Location not found', 404)
+    return api_response(dict(location))
+
+@app.route(f'{API_PREFIX}/locations/<location_id>', methods=['DELETE'])
+def api_delete_location(location_id):
+    """Delete a location that has no movements"""
+    conn = get_db_connection()
+    try:
+        deleted = remove_location(conn, location_id)
+    except sqlite3.IntegrityError:
+        conn.close()
+        return api_error('Cannot delete location with existing movements', 409)
+    conn.commit()
+    conn.close()
+    if not deleted:
+        return api_error('Location not found', 404)
+    return '', 204
+
+# Search
+@app.route(f'{API_PREFIX}/search', methods=['GET'])
+def api_search():
+    """Typeahead: best matches for ?q= among products and locations (narrow with ?kind=product|location)"""
+    q = request.args.get('q', '')
+    kind = request.args.get('kind')
+    if kind not in (None, 'product', 'location'):
+        return api_error('kind must be product or location', 400)
+    # A negative LIMIT would return every match
+    limit = max(1, min(request.args.get('limit', TYPEAHEAD_DEFAULT_LIMIT, type=int) or TYPEAHEAD_DEFAULT_LIMIT,
+                       TYPEAHEAD_MAX_LIMIT))
+    
+    conn = get_db_connection()
+    payload = {}
+    if kind in (None, 'product'):
+        payload['products'] = [dict(row) for row in search_products(conn, q, limit)]
+    if kind in (None, 'location'):
+        payload['locations'] = [dict(row) for row in search_locations(conn, q, limit)]
+    conn.close()
+    return api_response(payload)
+
+# Movements
+@app.route(f'{API_PREFIX}/movements', methods=['GET'])
+def api_list_movements():
+    """List movements newest first; same filters and cursor as /movements"""
+    filters = {key: request.args.get(key, '') for key in MOVEMENT_FILTERS}
+    cursor = parse_movement_cursor(request.args.get('cursor'))
+    # SQLite reads a negative LIMIT as no limit at all, so the floor matters as much as the cap
+    limit = max(1, min(request.args.get('limit', API_DEFAULT_PAGE_SIZE, type=int) or API_DEFAULT_PAGE_SIZE,
+                       API_MAX_PAGE_SIZE))
+    
+    conn = get_db_connection()
+    movements = list_movements(conn, filters, cursor, limit + 1)
+    conn.close()
+    
+    next_cursor = None
+    if len(movements) > limit:
+        movements = movements[:limit]
+        next_cursor = movement_cursor(movements[-1])
+    return api_response({'movements': [movement_payload(row) for row in movements], 'next_cursor': next_cursor})
+
+@app.route(f'{API_PREFIX}/movements', methods=['POST'])
+def api_create_movement():
+    """Record a movement"""
+    values, error = parse_movement_payload(api_payload())
+    if error:
+        return api_error(error, 400)
+    
+    conn = get_db_connection()
+    try:
+        movement_id = create_movement(conn, *values)
+        conn.commit()
+    except InsufficientStockError as e:
+        conn.close()
+        return api_error(str(e), 409)
+    except sqlite3.IntegrityError as e:
+        conn.close()
+        return api_error(f'Error adding movement: {e}', 400)
+    movement = get_movement(conn, movement_id)
+    conn.close()
+    return api_response(movement_payload(movement), 201)
+
+@app.route(f'{API_PREFIX}/movements/<movement_id>', methods=['GET'])
+def api_get_movement(movement_id):
+    """Get one movement"""
+    conn = get_db_connection()
+    movement = get_movement(conn, movement_id)
+    conn.close()
+    if movement is None:
+        return api_error('Movement not found', 404)
+    return api_response(movement_payload(movement))
+
+@app.route(f'{API_PREFIX}/movements/<movement_id>', methods=['PUT'])
+def api_update_movement(movement_id):
+    """Update a movement's product, locations and quantity"""
+    values, error = parse_movement_payload(api_payload())
+    if error:
+        return api_error(error, 400)
+    
+    conn = get_db_connection()
+    try:
+        found = update_movement(conn, movement_id, *values)
+        conn.commit()
+    except (InsufficientStockError, ClosedPeriodError) as e:
+        conn.close()
+        return api_error(str(e), 409)
+    except sqlite3.IntegrityError as e:
+        conn.close()
+        return api_error(f'Error updating movement: {e}', 400)
+    movement = get_movement(conn, movement_id)
+    conn.close()
+    if not found:
+        return api_error('Movement not found', 404)
+    return api_response(movement_payload(movement))
+
+@app.route(f'{API_PREFIX}/movements/<movement_id>', methods=['DELETE'])
+def api_delete_movement(movement_id):
+    """Delete a movement"""
+    conn = get_db_connection()
+    try:
+        found = remove_movement(conn, movement_id)
+        conn.commit()
+    except (InsufficientStockError, ClosedPeriodError) as e:
+        conn.close()
+        return api_error(str(e), 409)
+    conn.close()
+    if not found:
+        return api_error('Movement not found', 404)
+    return '', 204
+
+# Jobs
+def job_payload(job):
+    """Public shape of a job; result_url is set once the result can be downloaded"""
+    payload = {key: job[key] for key in ('job_id', 'kind', 'format', 'status', 'created_at',
+                                         'started_at', 'finished_at', 'snapshot_at', 'error')}
+    payload['params'] = json.loads(job['params'])
+    payload['result_url'] = url_for('api_job_result', job_id=job['job_id']) if job['status'] == 'done' else None
+    return payload
+
+@app.route(f'{API_PREFIX}/jobs', methods=['POST'])
+def api_create_job():
+    """Queue a balances or movements export; poll the returned job until it is done"""
+    data = api_payload()
+    kind = data.get('kind')
+    export_format = data.get('format', 'csv')
+    params = data.get('params') or {}
+    if kind not in EXPORT_COLUMNS:
+        return api_error(f"kind must be one of {', '.join(EXPORT_COLUMNS)}", 400)
+    if export_format not in JOB_FORMATS:
+        return api_error(f"format must be one of {', '.join(JOB_FORMATS)}", 400)
+    if export_format == 'xlsx' and not xlsx_available():
+        return api_error('XLSX export requires the openpyxl package', 400)
+    if not isinstance(params, dict) or not all(isinstance(value, str) for value in params.values()):
+        return api_error('params must be an object of strings', 400)
+    if params.get('as_of') and parse_as_of(params['as_of']) is None:
+        return api_error('as_of must be YYYY-MM-DD or YYYY-MM-DD HH:MM:SS', 400)
+    
+    conn = get_db_connection()
+    job_id = enqueue_job(conn, kind, export_format, params)
+    conn.commit()
+    job = get_job(conn, job_id)
+    conn.close()
+    response = api_response(job_payload(job), 202)
+    response.headers['Location'] = url_for('api_get_job', job_id=job_id)
+    return response
+
+@app.route(f'{API_PREFIX}/jobs/<job_id>', methods=['GET'])
+def api_get_job(job_id):
+    """A job's status"""
+    conn = get_db_connection()
+    job = get_job(conn, job_id)
+    conn.close()
+    if job is None:
+        return api_error('Job not found', 404)
+    return api_response(job_payload(job))
+
+@app.route(f'{API_PREFIX}/jobs/<job_id>/result', methods=['GET'])
+def api_job_result(job_id):
+    """Download a finished job's file"""
+    conn = get_db_connection()
+    job = get_job(conn, job_id)
+    conn.close()
+    if job is None:
+        return api_error('Job not found', 404)
+    if job['status'] != 'done':
+        return api_error(f"Job is {job['status']}", 409)
+    if not os.path.exists(job['result_path']):
+        return api_error('Job result has expired', 410)
+    return send_file(job['result_path'], as_attachment=True,
+                     download_name=export_filename(job['kind'], job['format']))
+
+# Balances
+@app.route(f'{API_PREFIX}/balances', methods=['GET'])
+def api_balances():
+    """Non-zero balances, optionally for one product and/or location and as of a past date"""
+    product_id = request.args.get('product_id')
+    location_id = request.args.get('location_id')
+    as_of = None
+    if request.args.get('as_of'):
+        as_of = parse_as_of(request.args['as_of'])
+        if as_of is None:
+            return api_error('as_of must be YYYY-MM-DD or YYYY-MM-DD HH:MM:SS', 400)
+    
+    conn = get_db_connection()
+    if as_of:
+        balances = [row for row in compute_balances_as_of(conn, as_of)
+                    if (not product_id or row['product_id'] == product_id)
+                    and (not location_id or row['location_id'] == location_id)]
+    else:
+        balances = get_stock_balances(conn, product_id, location_id)
+    conn.close()
+    return api_response({'balances': [dict(row) for row in balances], 'as_of': as_of})
+
+# Transfer documents
+@app.route(f'{API_PREFIX}/transfers', methods=['POST'])
+def api_create_transfer():
+    """Record a transfer document: from/to locations, optional timestamp and reference, and lines"""
+    data = api_payload()
+    header, error = parse_transfer_header(data)
+    if not error:
+        lines, error = parse_transfer_lines(data.get('lines'))
+    if error:
+        return api_error(error, 400)
+    
+    from_location, to_location, timestamp, reference = header
+    conn = get_db_connection()
+    try:
+        document = create_transfer_document(conn, from_location, to_location, lines, timestamp, reference)
+        conn.commit()
+    except (InsufficientStockError, ClosedPeriodError) as e:
+        conn.close()
+        return api_error(str(e), 409)
+    except sqlite3.IntegrityError as e:
+        conn.close()
+        return api_error(f'Error adding transfer: {e}', 400)
+    transfer = get_transfer_document(conn, document)
+    conn.close()
+    return api_response(transfer, 201)
+
+@app.route(f'{API_PREFIX}/transfers/<int:document>', methods=['GET'])
+def api_get_transfer(document):
+    """A transfer document with its lines"""
+    conn = get_db_connection()
+    transfer = get_transfer_document(conn, document)
+    conn.close()
+    if transfer is None:
+        return api_error('Transfer document not found', 404)
+    return api_response(transfer)
+
+# Analytics
+@app.route(f'{API_PREFIX}/analytics', methods=['GET'])
+def api_analytics():
+    """Window totals, velocity, turnover and days of stock, plus a bucketed series"""
+    product_id = request.args.get('product_id')
+    location_id = request.args.get('location_id')
+    days = parse_analytics_days(request.args.get('days'))
+    if days is None:
+        return api_error(f'days must be a whole number from 1 to {ANALYTICS_MAX_DAYS}', 400)
+    bucket = request.args.get('bucket') or ANALYTICS_DEFAULT_BUCKET
+    if bucket not in ANALYTICS_BUCKETS:
+        return api_error(f"bucket must be one of {', '.join(ANALYTICS_BUCKETS)}", 400)
+    
+    first_day, last_day = analytics_window(days)
+    conn, snapshot_at = get_report_connection()
+    rows = compute_analytics(conn, days, product_id, location_id)
+    series = compute_movement_series(conn, days, bucket, product_id, location_id)
+    conn.close()
+    return api_response({
+        'days': days,
+        'from': from_epoch(first_day * SECONDS_PER_DAY)[:10],
+        'to': from_epoch(last_day * SECONDS_PER_DAY)[:10],
+        'bucket': bucket,
+        'rows': rows,
+        'series': series,
+        'snapshot_at': snapshot_at,
+    })
+
+# Startup
+# warm_up() gets a worker process ready before it takes traffic, so its first
+# requests do not pay for the schema check, template compilation or filling the
+# reference-data cache, and a hot statement that no longer prepares fails at
+# startup instead of on a request. serve.py calls it with one ready connection
+# per request thread; servers that import app:app directly run it on import
+# with INVENTORY_WARM_UP=1, without connections, since they may fork after it.
+def precompile_templates():
+    """Compile every template into Jinja's in-memory and bytecode caches; returns how many"""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+def warm_up(connections=0):
+    """Initialize the database, compile templates and fill the caches.
+
+    With `connections`, also open that many request connections ahead of time
+    (one per request thread), each with its PRAGMAs applied and the schema
+    already read by planning the hot queries; threads take them instead of
+    connecting on their first request. Leave it at 0 when the process may
+    fork afterwards.
+    """
+    init_db()
+    precompile_templates()
+    
+    # A separate connection, closed again, so nothing is shared with a process forked after this
+    conn = open_db_connection()
+    for name, sql in hot_queries().items():
+        # Planning reads the schema, statistics and index roots into the OS page cache
+        if find_table_scans(conn, sql):
+            app.logger.warning('Hot query %r falls back to a full table scan', name)
+    get_reference_data(conn)
+    conn.dispose()
+    
+    for _ in range(connections):
+        # Opened here and used by exactly one request thread from then on
+        conn = open_db_connection(check_same_thread=False)
+        for sql in hot_queries().values():
+            find_table_scans(conn, sql)
+        _warm_connections.put((DATABASE, conn))
+
+if os.environ.get('INVENTORY_WARM_UP') == '1':
+    warm_up()
 
 if __name__ == '__main__':
     init_db()
+    # The debug reloader runs the app in a child process; only that one works on jobs
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_job_worker()
     app.run(debug=True)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Benchmark the set-based balance engine against the original per-pair loop
+
+The loop runs on a copy of the data in the original schema (text keys, no
+indexes), exactly as balance_report ran it before the engine replaced it; the
+engine runs on the current schema.
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app
+
+# (products, locations, movements) per run
+SIZES = [
+    (10, 5, 1000),
+    (50, 10, 10000),
+    (100, 20, 25000),
+    (200, 20, 50000),
+]
+
+# The schema the original loop ran on
+BASELINE_SCHEMA = [
+    '''
+        CREATE TABLE Product (
+            product_id TEXT PRIMARY KEY,
+            product_name TEXT NOT NULL,
+            description TEXT
+        )
+    ''',
+    '''
+        CREATE TABLE Location (
+            location_id TEXT PRIMARY KEY,
+            location_name TEXT NOT NULL,
+            address TEXT
+        )
+    ''',
+    '''
+        CREATE TABLE ProductMovement (
+            movement_id TEXT PRIMARY KEY,
+            timestamp TEXT NOT NULL,
+            from_location TEXT,
+            to_location TEXT,
+            product_id TEXT NOT NULL,
+            qty INTEGER NOT NULL,
+            FOREIGN KEY (from_location) REFERENCES Location (location_id),
+            FOREIGN KEY (to_location) REFERENCES Location (location_id),
+            FOREIGN KEY (product_id) REFERENCES Product (product_id)
+        )
+    ''',
+]
+
+def legacy_balances(conn):
+    """Original balance_report loop on the baseline schema: two SUM queries per product/location pair"""
+    products = conn.execute('SELECT * FROM Product ORDER BY product_name').fetchall()
+    locations = conn.execute('SELECT * FROM Location ORDER BY location_name').fetchall()
+
+    balances = []
+    for product in products:
+        for location in locations:
+            incoming = conn.execute('''
+                SELECT COALESCE(SUM(qty), 0) as total
+                FROM ProductMovement
+                WHERE product_id = ? AND to_location = ?
+            ''', (product['product_id'], location['location_id'])).fetchone()
+
+            outgoing = conn.execute('''
+                SELECT COALESCE(SUM(qty), 0) as total
+                FROM ProductMovement
+                WHERE product_id = ? AND from_location = ?
+            ''', (product['product_id'], location['location_id'])).fetchone()
+
+            balance = incoming['total'] - outgoing['total']
+
+            if balance != 0:
+                balances.append({
+                    'product_id': product['product_id'],
+                    'product_name': product['product_name'],
+                    'location_id': location['location_id'],
+                    'location_name': location['location_name'],
+                    'balance': balance
+                })
+    return balances
+
+def generate(n_products, n_locations, n_movements):
+    """Random products, locations and movements in the original text form"""
+    products = [(f'P{i:05d}', f'Product P{i:05d}', None) for i in range(n_products)]
+    locations = [(f'L{i:04d}', f'Location L{i:04d}', None) for i in range(n_locations)]
+    location_ids = [location[0] for location in locations]
+
+    movements = []
+    for _ in range(n_movements):
+        kind = random.choice(['incoming', 'outgoing', 'transfer'])
+        from_location = random.choice(location_ids) if kind != 'incoming' else None
+        to_location = random.choice(location_ids) if kind != 'outgoing' else None
+        movements.append((str(uuid.uuid4()), '2024-01-01 00:00:00', from_location, to_location,
+                          random.choice(products)[0], random.randint(1, 50)))
+    return products, locations, movements
+
+def populate_baseline(conn, products, locations, movements):
+    """Create the baseline schema and load the data as the original app stored it"""
+    for statement in BASELINE_SCHEMA:
+        conn.execute(statement)
+    conn.executemany('INSERT INTO Product VALUES (?, ?, ?)', products)
+    conn.executemany('INSERT INTO Location VALUES (?, ?, ?)', locations)
+    conn.executemany('''
+        INSERT INTO ProductMovement (movement_id, timestamp, from_location, to_location, product_id, qty)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', movements)
+    conn.commit()
+
+def populate(conn, products, locations, movements):
+    """Load the same data into the current schema"""
+    conn.executemany('INSERT INTO Product (product_id, product_name, description) VALUES (?, ?, ?)', products)
+    conn.executemany('INSERT INTO Location (location_id, location_name, address) VALUES (?, ?, ?)', locations)
+    product_keys = dict(conn.execute('SELECT product_id, product_key FROM Product').fetchall())
+    location_keys = dict(conn.execute('SELECT location_id, location_key FROM Location').fetchall())
+    location_keys[None] = None
+
+    conn.executemany('''
+        INSERT INTO ProductMovement (movement_id, moved_at, from_location_key, to_location_key, product_key, qty)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(app.movement_id_key(movement_id), app.to_epoch(timestamp), location_keys[from_location],
+           location_keys[to_location], product_keys[product_id], qty)
+          for movement_id, timestamp, from_location, to_location, product_id, qty in movements])
+    conn.commit()
+
+def timed(func, conn):
+    start = time.perf_counter()
+    result = func(conn)
+    return result, time.perf_counter() - start
+
+def balance_rows(balances):
+    """Balances as sorted tuples; the original loop orders by name only"""
+    return sorted(tuple(row[column] for column in app.EXPORT_COLUMNS['balances']) for row in balances)
+
+def main():
+    random.seed(42)
+    print(f"{'products':>8} {'locations':>9} {'movements':>9} {'loop (s)':>10} {'engine (s)':>10} {'speedup':>8}")
+
+    for n_products, n_locations, n_movements in SIZES:
+        products, locations, movements = generate(n_products, n_locations, n_movements)
+        with tempfile.TemporaryDirectory() as tmp:
+            baseline = sqlite3.connect(os.path.join(tmp, 'baseline.db'))
+            baseline.row_factory = sqlite3.Row
+            populate_baseline(baseline, products, locations, movements)
+            expected, loop_time = timed(legacy_balances, baseline)
+            baseline.close()
+
+            app.DATABASE = os.path.join(tmp, 'bench.db')
+            app.init_db()
+            conn = sqlite3.connect(app.DATABASE)
+            conn.row_factory = sqlite3.Row
+            populate(conn, products, locations, movements)
+            actual, engine_time = timed(app.compute_balances, conn)
+            conn.close()
+
+        if balance_rows(actual) != balance_rows(expected):
+            print('Balance engine results differ from the legacy loop!')
+            sys.exit(1)
+
+        print(f'{n_products:>8} {n_locations:>9} {n_movements:>9} '
+              f'{loop_time:>10.3f} {engine_time:>10.3f} {loop_time / engine_time:>7.1f}x')
+
+if __name__ == '__main__':
+    main()
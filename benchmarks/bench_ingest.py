@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Benchmark bulk movement ingestion (rows/sec) for CSV and NDJSON input
+"""
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app
+
+N_PRODUCTS = 500
+N_LOCATIONS = 50
+N_ROWS = 100000
+CHUNK_SIZES = [500, 5000, 50000]
+
+def write_input(path, data_format, product_ids, location_ids):
+    """Write N_ROWS random movements to path"""
+    with open(path, 'w', newline='') as f:
+        if data_format == 'csv':
+            f.write('product_id,from_location,to_location,qty\n')
+        for _ in range(N_ROWS):
+            from_location, to_location = random.sample(location_ids, 2)
+            kind = random.random()
+            if kind < 0.4:
+                from_location = ''
+            elif kind < 0.6:
+                to_location = ''
+            row = {'product_id': random.choice(product_ids), 'from_location': from_location,
+                   'to_location': to_location, 'qty': random.randint(1, 50)}
+            if data_format == 'csv':
+                f.write(f"{row['product_id']},{row['from_location']},{row['to_location']},{row['qty']}\n")
+            else:
+                f.write(json.dumps(row) + '\n')
+
+def run(tmp, data_format, chunk_size):
+    app.DATABASE = os.path.join(tmp, f'bench_{data_format}_{chunk_size}.db')
+    app.init_db()
+    conn = app.open_db_connection()
+    product_ids = [f'P{i:05d}' for i in range(N_PRODUCTS)]
+    location_ids = [f'L{i:04d}' for i in range(N_LOCATIONS)]
+    conn.executemany('INSERT INTO Product (product_id, product_name, description) VALUES (?, ?, ?)',
+                     [(p, p, None) for p in product_ids])
+    conn.executemany('INSERT INTO Location (location_id, location_name, address) VALUES (?, ?, ?)',
+                     [(l, l, None) for l in location_ids])
+    conn.commit()
+
+    path = os.path.join(tmp, f'input.{data_format}')
+    write_input(path, data_format, product_ids, location_ids)
+
+    start = time.perf_counter()
+    with open(path, newline='') as stream:
+        result = app.ingest_movements(conn, app.ingest_row_reader(stream, data_format), chunk_size=chunk_size)
+    elapsed = time.perf_counter() - start
+    conn.dispose()
+
+    if result['inserted'] != N_ROWS:
+        print(f'Expected {N_ROWS} rows, inserted {result["inserted"]}: {result["errors"][:5]}')
+        sys.exit(1)
+    return elapsed
+
+def main():
+    random.seed(42)
+    print(f"{'format':>7} {'chunk':>7} {'rows':>8} {'seconds':>8} {'rows/sec':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for data_format in ('csv', 'ndjson'):
+            for chunk_size in CHUNK_SIZES:
+                elapsed = run(tmp, data_format, chunk_size)
+                print(f'{data_format:>7} {chunk_size:>7} {N_ROWS:>8} {elapsed:>8.2f} {N_ROWS / elapsed:>10.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Time every route and query path at several dataset sizes and write the
+results to a JSON file that can be compared between versions.
+
+    python benchmarks/bench_routes.py --output before.json
+    python benchmarks/bench_routes.py --sizes small,medium --repeat 20 --output after.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app
+import add_test_data
+
+# name -> (products, locations, movements)
+SIZES = {
+    'small': (100, 10, 10000),
+    'medium': (1000, 50, 100000),
+    'large': (5000, 200, 1000000),
+}
+SKEW = 1.1
+SEED = 42
+
+def git_revision():
+    """Current commit hash, or None outside a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def route_cases(conn):
+    """Routes to time, as name -> URL; IDs are picked from the generated data"""
+    busiest_product = conn.execute('SELECT product_id FROM Product ORDER BY product_id LIMIT 1').fetchone()[0]
+    busiest_location = conn.execute('SELECT location_id FROM Location ORDER BY location_id LIMIT 1').fetchone()[0]
+    select_sql = app.MOVEMENT_SELECT_SQL.format(table='ProductMovement')
+    middle = conn.execute(
+        f'{select_sql} ORDER BY pm.moved_at, pm.movement_key LIMIT 1 OFFSET '
+        '(SELECT COUNT(*) / 2 FROM ProductMovement)').fetchone()
+    movement_id, timestamp = middle['movement_id'], middle['timestamp']
+    cursor = app.movement_cursor(middle)
+    return {
+        'home': '/',
+        'products': '/products',
+        'locations': '/locations',
+        'movements': '/movements',
+        'movements deep page': f'/movements?cursor={cursor}',
+        'movements by product': f'/movements?product_id={busiest_product}',
+        'movements by location': f'/movements?location_id={busiest_location}',
+        'add movement form': '/movements/add',
+        'edit movement form': f'/movements/edit/{movement_id}',
+        'product delete guard': f'/products/delete/{busiest_product}',
+        'location delete guard': f'/locations/delete/{busiest_location}',
+        'balance report': '/balance-report',
+        'balance report as of': f'/balance-report?as_of={timestamp}',
+        'analytics': '/analytics',
+        'analytics by product': f'/analytics?product_id={busiest_product}&bucket=day',
+        'api products': '/api/v1/products',
+        'api movements': '/api/v1/movements',
+        'api balances': '/api/v1/balances',
+        'api analytics': '/api/v1/analytics?days=365&bucket=month',
+    }
+
+def query_cases():
+    """Query paths to time directly, as name -> function(conn)"""
+    return {
+        'compute_balances': app.compute_balances,
+        'get_stock_balances': app.get_stock_balances,
+        'get_reference_data': app.get_reference_data,
+        'balance_drift': app.balance_drift,
+    }
+
+def measure(func, repeat, setup=None):
+    """Run func `repeat` times after one warm-up call; returns timing stats in ms.
+
+    setup, if given, runs untimed before every call.
+    """
+    func()
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'min_ms': round(samples[0], 3),
+        'median_ms': round(statistics.median(samples), 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        'max_ms': round(samples[-1], 3),
+    }
+
+def bench_size(name, products, locations, movements, repeat, tmp):
+    """Generate one dataset and time every case against it"""
+    database = os.path.join(tmp, f'{name}.db')
+    add_test_data.generate_data(database, products, locations, movements, SKEW, seed=SEED)
+    app.DATABASE = database
+    app.init_db()
+    client = app.app.test_client()
+
+    conn = app.open_db_connection()
+    app.create_checkpoints(conn)
+    routes = route_cases(conn)
+    conn.dispose()
+
+    results = {}
+    for case, url in routes.items():
+        def request():
+            response = client.get(url)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{url} returned {response.status_code}')
+        # Rendered pages are cached; clearing the cache first keeps these
+        # timings comparable with versions that had no response cache
+        results[f'GET {case}'] = measure(request, repeat, setup=app.response_cache.clear)
+        print(f"  {case:<30} {results[f'GET {case}']['median_ms']:>10.2f} ms")
+
+        hits = app.response_cache.stats()['hits']
+        cached = measure(request, repeat)
+        if app.response_cache.stats()['hits'] > hits:
+            results[f'GET {case} (cached)'] = cached
+            print(f"  {case + ' (cached)':<30} {cached['median_ms']:>10.2f} ms")
+
+    conn = app.open_db_connection()
+    for case, func in query_cases().items():
+        results[case] = measure(lambda: func(conn), repeat)
+        print(f"  {case:<30} {results[case]['median_ms']:>10.2f} ms")
+    conn.dispose()
+    app.close_thread_connection()
+
+    return {'name': name, 'products': products, 'locations': locations, 'movements': movements,
+            'database_bytes': os.path.getsize(database), 'results': results}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark routes and query paths at several dataset sizes')
+    parser.add_argument('--sizes', default='small,medium', help=f'comma-separated subset of {", ".join(SIZES)}')
+    parser.add_argument('--repeat', type=int, default=10, help='timed runs per case (default: %(default)s)')
+    parser.add_argument('--output', default='bench_results.json', help='JSON results file (default: %(default)s)')
+    args = parser.parse_args()
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'repeat': args.repeat,
+        'skew': SKEW,
+        'sizes': [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.sizes.split(','):
+            products, locations, movements = SIZES[name]
+            print(f'{name}: {products} products, {locations} locations, {movements} movements')
+            report['sizes'].append(bench_size(name, products, locations, movements, args.repeat, tmp))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    main()
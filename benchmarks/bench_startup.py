@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Measure time-to-first-request of a fresh worker process: import, startup and
+the first hit on each route, with the plain init_db() startup and with
+warm_up().
+
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --products 1000 --locations 50 --movements 100000 --output startup.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+# app is not imported at the top: each run times its own import in a new process
+
+ROUTES = ['/', '/products', '/movements', '/movements/add', '/balance-report', '/analytics']
+STARTUPS = ['init_db', 'warm_up']
+
+def child(startup, database):
+    """Run in a fresh process: time the import, the startup and the first hit on each route"""
+    start = time.perf_counter()
+    import app
+    imported = time.perf_counter()
+    app.DATABASE = database
+    if startup == 'warm_up':
+        # The test client serves on this thread; serve.py opens one connection per request thread
+        app.warm_up(connections=1)
+    else:
+        app.init_db()
+    ready = time.perf_counter()
+
+    client = app.app.test_client()
+    timings = {'import': imported - start, 'startup': ready - imported, 'routes': {}}
+    for route in ROUTES:
+        route_start = time.perf_counter()
+        status = client.get(route).status_code
+        if status != 200:
+            raise SystemExit(f'{route} returned {status}')
+        timings['routes'][route] = time.perf_counter() - route_start
+        if route == ROUTES[0]:
+            timings['first request'] = time.perf_counter() - start
+    timings['all routes'] = time.perf_counter() - start
+    json.dump(timings, sys.stdout)
+
+def run_child(startup, database):
+    """Timings of one fresh process"""
+    env = {key: value for key, value in os.environ.items() if key != 'INVENTORY_WARM_UP'}
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', startup, database],
+                            capture_output=True, text=True, check=True, cwd=ROOT, env=env).stdout
+    return json.loads(output)
+
+def median_timings(runs):
+    """Median of each timing across runs"""
+    return {
+        'import': statistics.median(run['import'] for run in runs),
+        'startup': statistics.median(run['startup'] for run in runs),
+        'first request': statistics.median(run['first request'] for run in runs),
+        'all routes': statistics.median(run['all routes'] for run in runs),
+        'routes': {route: statistics.median(run['routes'][route] for run in runs) for route in ROUTES},
+    }
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        child(sys.argv[2], sys.argv[3])
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmark worker startup and time-to-first-request')
+    parser.add_argument('--runs', type=int, default=10, help='fresh processes per startup mode (default: %(default)s)')
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--locations', type=int, default=50)
+    parser.add_argument('--movements', type=int, default=100000)
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    import add_test_data
+
+    report = {'runs': args.runs, 'products': args.products, 'locations': args.locations,
+              'movements': args.movements, 'startups': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'startup.db')
+        add_test_data.generate_data(database, args.products, args.locations, args.movements, seed=42)
+        # One discarded run per mode fills the OS page cache and Jinja's bytecode cache
+        for startup in STARTUPS:
+            run_child(startup, database)
+
+        # Interleave the modes so drift on the machine affects both alike
+        runs = {startup: [] for startup in STARTUPS}
+        for _ in range(args.runs):
+            for startup in STARTUPS:
+                runs[startup].append(run_child(startup, database))
+
+    print(f"\n{'':24}" + ''.join(f'{startup:>12}' for startup in STARTUPS))
+    medians = {startup: median_timings(runs[startup]) for startup in STARTUPS}
+    for name in ['import', 'startup', 'first request', 'all routes']:
+        print(f'{name:24}' + ''.join(f'{medians[startup][name] * 1000:10.1f}ms' for startup in STARTUPS))
+    print('first hit per route:')
+    for route in ROUTES:
+        print(f'  {route:22}' + ''.join(f'{medians[startup]["routes"][route] * 1000:10.1f}ms'
+                                        for startup in STARTUPS))
+
+    report['startups'] = medians
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Compare database size and scan speed of the text-keyed movement layout with
+the compact layout (integer keys, epoch-second timestamps, binary UUIDs).
+
+The same random history is written in the old layout, then a copy is
+upgraded with the real migration, so the numbers also cover the migration.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app
+
+# Last schema version with text keys and text timestamps
+LEGACY_VERSION = 8
+REPEAT = 5
+
+LEGACY_QUERIES = {
+    'full scan': 'SELECT COUNT(*), SUM(qty) FROM ProductMovement',
+    'balance aggregate': '''
+        SELECT product_id, location_id, SUM(qty)
+        FROM (
+            SELECT product_id, to_location as location_id, qty FROM ProductMovement WHERE to_location IS NOT NULL
+            UNION ALL
+            SELECT product_id, from_location, -qty FROM ProductMovement WHERE from_location IS NOT NULL
+        )
+        GROUP BY product_id, location_id
+    ''',
+    'one day of movements': '''
+        SELECT COUNT(*), SUM(qty) FROM ProductMovement
+        WHERE timestamp >= '2024-01-15 00:00:00' AND timestamp < '2024-01-16 00:00:00'
+    ''',
+}
+
+COMPACT_QUERIES = {
+    'full scan': LEGACY_QUERIES['full scan'],
+    'balance aggregate': app.BALANCE_AGGREGATE_SQL,
+    'one day of movements': f'''
+        SELECT COUNT(*), SUM(qty) FROM ProductMovement
+        WHERE moved_at >= {app.to_epoch('2024-01-15 00:00:00')} AND moved_at < {app.to_epoch('2024-01-16 00:00:00')}
+    ''',
+}
+
+def migrate_to(conn, version):
+    """Apply migrations up to `version` the way app.migrate does"""
+    current = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(app.MIGRATIONS[current:version], start=current + 1):
+        conn.execute('BEGIN')
+        migration(conn)
+        conn.execute(f'PRAGMA user_version = {number}')
+        conn.commit()
+
+def build_legacy_database(path, n_products, n_locations, n_movements):
+    """Write a random history in the text-keyed layout"""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    migrate_to(conn, 1)
+    product_ids = [f'P{i:05d}' for i in range(n_products)]
+    location_ids = [f'L{i:04d}' for i in range(n_locations)]
+    conn.executemany('INSERT INTO Product (product_id, product_name, description) VALUES (?, ?, ?)',
+                     [(p, f'Product {p}', f'Description of {p}') for p in product_ids])
+    conn.executemany('INSERT INTO Location (location_id, location_name, address) VALUES (?, ?, ?)',
+                     [(l, f'Location {l}', f'{l} Test Street') for l in location_ids])
+
+    start = datetime(2024, 1, 1)
+    step = timedelta(days=30) / n_movements
+    movements = []
+    for i in range(n_movements):
+        kind = random.choice(['incoming', 'outgoing', 'transfer'])
+        from_location, to_location = random.sample(location_ids, 2)
+        if kind == 'incoming':
+            from_location = None
+        elif kind == 'outgoing':
+            to_location = None
+        movements.append((str(uuid.uuid4()), (start + step * i).strftime(app.TIMESTAMP_FORMAT),
+                          from_location, to_location, random.choice(product_ids), random.randint(1, 50)))
+    conn.executemany('''
+        INSERT INTO ProductMovement (movement_id, timestamp, from_location, to_location, product_id, qty)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', movements)
+    conn.commit()
+    # The remaining legacy migrations fill StockBalance and build the indexes
+    migrate_to(conn, LEGACY_VERSION)
+    conn.close()
+
+def vacuum(path):
+    """Compact the file so free pages left by the writes do not count"""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.execute('VACUUM')
+    conn.close()
+
+def object_sizes(path):
+    """Bytes used by each table together with its indexes"""
+    conn = sqlite3.connect(path)
+    sizes = conn.execute('''
+        SELECT COALESCE(m.tbl_name, d.name), SUM(d.pgsize)
+        FROM dbstat d LEFT JOIN sqlite_schema m ON m.name = d.name
+        GROUP BY 1
+    ''').fetchall()
+    conn.close()
+    return dict(sizes)
+
+def time_query(path, sql):
+    """Best of REPEAT runs of `sql`, each on a fresh connection"""
+    best = None
+    for _ in range(REPEAT):
+        conn = sqlite3.connect(path)
+        start = time.perf_counter()
+        conn.execute(sql).fetchall()
+        elapsed = time.perf_counter() - start
+        conn.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--locations', type=int, default=50)
+    parser.add_argument('--movements', type=int, default=200000)
+    args = parser.parse_args()
+    random.seed(42)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = os.path.join(tmp, 'legacy.db')
+        compact = os.path.join(tmp, 'compact.db')
+        build_legacy_database(legacy, args.products, args.locations, args.movements)
+        vacuum(legacy)
+
+        shutil.copy(legacy, compact)
+        conn = sqlite3.connect(compact)
+        start = time.perf_counter()
+        app.migrate(conn)
+        migration_time = time.perf_counter() - start
+        conn.close()
+        vacuum(compact)
+
+        print(f'{args.movements} movements, {args.products} products, {args.locations} locations')
+        print(f'Migration took {migration_time:.2f}s\n')
+
+        legacy_sizes = object_sizes(legacy)
+        compact_sizes = object_sizes(compact)
+        print(f"{'size (KiB)':<28} {'legacy':>10} {'compact':>10} {'ratio':>7}")
+        for name in ('ProductMovement', 'StockBalance', 'Product', 'Location'):
+            print(f'{name:<28} {legacy_sizes[name] // 1024:>10} {compact_sizes[name] // 1024:>10} '
+                  f'{legacy_sizes[name] / compact_sizes[name]:>6.1f}x')
+        legacy_file = os.path.getsize(legacy)
+        compact_file = os.path.getsize(compact)
+        print(f"{'whole file':<28} {legacy_file // 1024:>10} {compact_file // 1024:>10} "
+              f'{legacy_file / compact_file:>6.1f}x\n')
+
+        print(f"{'query (ms)':<28} {'legacy':>10} {'compact':>10} {'speedup':>7}")
+        for name, sql in LEGACY_QUERIES.items():
+            legacy_time = time_query(legacy, sql)
+            compact_time = time_query(compact, COMPACT_QUERIES[name])
+            print(f'{name:<28} {legacy_time * 1000:>10.1f} {compact_time * 1000:>10.1f} '
+                  f'{legacy_time / compact_time:>6.1f}x')
+
+if __name__ == '__main__':
+    main()
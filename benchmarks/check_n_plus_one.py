@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Check request profiling's N+1 detection: batched writes (a bulk ingest, a
+transfer document with many lines) must not be flagged, while one statement
+run in a loop must be. Exits with status 1 on failure.
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app
+
+ROWS = 100
+PRODUCTS = [f'P{i:03d}' for i in range(ROWS)]
+LOCATIONS = ['L1', 'L2']
+
+def bulk_ingest(client):
+    """One 100-row CSV bulk ingest"""
+    body = 'product_id,from_location,to_location,qty\n' + ''.join(f'{p},,L1,5\n' for p in PRODUCTS)
+    return client.post('/api/v1/movements/bulk', data=body, content_type='text/csv')
+
+def transfer(client):
+    """One transfer document with a line per product"""
+    return client.post('/api/v1/transfers', json={
+        'from_location': 'L1', 'to_location': 'L2',
+        'lines': [{'product_id': p, 'qty': 1} for p in PRODUCTS],
+    })
+
+def movement_loop(client):
+    """Products looked up one query at a time inside a request: a real N+1"""
+    with app.app.test_request_context('/api/v1/movements'):
+        app.start_request_profile()
+        conn = app.get_db_connection()
+        for product_id in PRODUCTS:
+            conn.execute('SELECT product_key FROM Product WHERE product_id = ?', (product_id,)).fetchone()
+        return app.finish_request_profile(app.app.response_class())
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        app.DATABASE = os.path.join(tmp, 'profile.db')
+        app.PROFILE_REQUESTS = True
+        app.init_db()
+
+        conn = app.open_db_connection()
+        conn.executemany('INSERT INTO Product (product_id, product_name) VALUES (?, ?)', [(p, p) for p in PRODUCTS])
+        conn.executemany('INSERT INTO Location (location_id, location_name) VALUES (?, ?)', [(l, l) for l in LOCATIONS])
+        conn.commit()
+        conn.dispose()
+
+        client = app.app.test_client()
+        failed = False
+        for name, case, expect_flag in (('bulk ingest', bulk_ingest, False), ('transfer document', transfer, False),
+                                        ('query loop', movement_loop, True)):
+            response = case(client)
+            flag = response.headers.get('X-N-Plus-One')
+            ok = response.status_code < 400 and bool(flag) == expect_flag
+            failed = failed or not ok
+            print(f"{name:<18} {response.status_code} {response.headers.get('X-SQL-Statements', '-'):>5} statements  "
+                  f"{'ok' if ok else 'FAILED'}  {flag or 'not flagged'}")
+        app.close_thread_connection()
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Stress strict stock mode with concurrent writers and check that no location
+ever goes below zero and no update is lost. Exits with status 1 on failure.
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app
+
+THREADS = 8
+OPERATIONS_PER_THREAD = 300
+PRODUCTS = ['P1', 'P2']
+LOCATIONS = ['L1', 'L2', 'L3']
+INITIAL_STOCK = 50
+
+def writer(seed, stats, errors):
+    """Randomly receive, ship, transfer, edit and delete movements"""
+    rng = random.Random(seed)
+    conn = app.open_db_connection()
+    mine = []
+    try:
+        for _ in range(OPERATIONS_PER_THREAD):
+            product_id = rng.choice(PRODUCTS)
+            from_location, to_location = rng.sample(LOCATIONS, 2)
+            action = rng.random()
+            try:
+                if action < 0.2:
+                    mine.append(app.create_movement(conn, product_id, None, to_location, rng.randint(1, 10)))
+                elif action < 0.5:
+                    mine.append(app.create_movement(conn, product_id, from_location, None, rng.randint(1, 15)))
+                elif action < 0.8:
+                    mine.append(app.create_movement(conn, product_id, from_location, to_location, rng.randint(1, 15)))
+                elif action < 0.9 and mine:
+                    app.update_movement(conn, rng.choice(mine), product_id, from_location, None, rng.randint(1, 15))
+                elif mine:
+                    app.remove_movement(conn, mine.pop(rng.randrange(len(mine))))
+                conn.commit()
+                stats['committed'] += 1
+            except app.InsufficientStockError:
+                conn.rollback()
+                stats['rejected'] += 1
+    except Exception as e:
+        errors.append(repr(e))
+    finally:
+        conn.dispose()
+
+def watcher(stop, violations):
+    """Keep checking that no stored balance is negative while writers run"""
+    conn = sqlite3.connect(app.DATABASE)
+    while not stop.is_set():
+        row = conn.execute('SELECT product_key, location_key, qty FROM StockBalance WHERE qty < 0 LIMIT 1').fetchone()
+        if row:
+            violations.append(row)
+        time.sleep(0.001)
+    conn.close()
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        app.DATABASE = os.path.join(tmp, 'stress.db')
+        app.STRICT_STOCK = True
+        app.init_db()
+
+        conn = app.open_db_connection()
+        conn.executemany('INSERT INTO Product (product_id, product_name) VALUES (?, ?)', [(p, p) for p in PRODUCTS])
+        conn.executemany('INSERT INTO Location (location_id, location_name) VALUES (?, ?)', [(l, l) for l in LOCATIONS])
+        for product_id in PRODUCTS:
+            for location_id in LOCATIONS:
+                app.create_movement(conn, product_id, None, location_id, INITIAL_STOCK)
+        conn.commit()
+
+        stats = {'committed': 0, 'rejected': 0}
+        errors = []
+        violations = []
+        stop = threading.Event()
+        watch = threading.Thread(target=watcher, args=(stop, violations))
+        watch.start()
+        start = time.perf_counter()
+        threads = [threading.Thread(target=writer, args=(seed, stats, errors)) for seed in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        watch.join()
+
+        drift = app.rebuild_balances(conn)
+        conn.rollback()
+        negative_final = conn.execute(app.BALANCE_AGGREGATE_SQL.replace('!= 0', '< 0')).fetchall()
+        conn.dispose()
+
+    print(f'{THREADS} writers, {stats["committed"]} committed, {stats["rejected"]} rejected '
+          f'in {elapsed:.2f}s ({stats["committed"] / elapsed:.0f} writes/sec)')
+    failed = False
+    for label, problems in (('Writer errors', errors), ('Negative balances seen', violations),
+                            ('Drift between StockBalance and history (lost updates)', drift),
+                            ('Negative balances in history', negative_final)):
+        if problems:
+            failed = True
+            print(f'{label}: {problems[:5]}')
+    print('FAILED' if failed else 'OK: no location went below zero and no update was lost')
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
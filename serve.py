@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Serve the inventory app in production: a multi-threaded WSGI server (waitress)
+plus background job workers in the same process.
+
+    python serve.py --host 0.0.0.0 --port 8000 --threads 8 --job-workers 1
+
+For several server processes, run any WSGI server against `app:app` instead
+(for example `gunicorn -w 4 app:app`) and start the job workers on their own
+with `flask --app app run-jobs`.
+"""
+
+import argparse
+import threading
+
+import app
+
+try:
+    import waitress
+except ImportError:  # Only needed to serve; the app itself does not depend on it
+    waitress = None
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the inventory app with background job workers')
+    parser.add_argument('--host', default='127.0.0.1', help='interface to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=8, help='request threads (default: %(default)s)')
+    parser.add_argument('--job-workers', type=int, default=1,
+                        help='background job worker threads; 0 to run them elsewhere (default: %(default)s)')
+    args = parser.parse_args()
+    if waitress is None:
+        parser.exit(1, 'serve.py needs the waitress package: pip install waitress\n')
+
+    app.warm_up(connections=args.threads)
+    stop = threading.Event()
+    workers = [app.start_job_worker(stop) for _ in range(args.job_workers)]
+    try:
+        waitress.serve(app.app, host=args.host, port=args.port, threads=args.threads)
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+if __name__ == '__main__':
+    main()